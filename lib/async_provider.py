@@ -0,0 +1,169 @@
+import select
+import time
+from collections import deque
+
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+from psycopg2.extras import DictCursor
+
+from lib.catalog import SchemaCatalog
+from lib.exception import DeadlineExceeded
+from lib.pg_objects import DBConnection, Database
+from lib.provider import DBProvider
+
+
+class AsyncIntrospection(object):
+    """
+    Introspection of a single database over an asynchronous connection. The bulk catalog queries are sent one after
+    the other, and poll() never blocks on the socket.
+    """
+
+    def __init__(self, db_connection, ignore_columns=None, ignore_tables=None, schema_name='public'):
+        self.db_connection = db_connection
+        self.catalog = SchemaCatalog(db_connection.database)
+        self.params = SchemaCatalog.query_params(schema_name, ignore_columns, ignore_tables)
+        self.queries = deque(self.catalog.bulk_queries)
+        self.started = time.time()
+        self.connection = db_connection.connect_async()
+        self.cursor = None
+        self.kind = None
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def poll(self):
+        """
+        Advance the introspection as far as possible without blocking.
+
+        :return: POLL_READ or POLL_WRITE while waiting on the socket, POLL_OK once every query has completed
+        """
+        while True:
+            state = self.connection.poll()
+            if state != POLL_OK:
+                return state
+
+            if self.cursor is None:
+                # Connected
+                self.cursor = self.connection.cursor(cursor_factory=DictCursor)
+            elif self.kind is not None:
+                self.catalog.add_rows(self.kind, self.cursor.fetchall())
+
+            if not self.queries:
+                return POLL_OK
+            self.kind, sql_select = self.queries.popleft()
+            self.cursor.execute(sql_select, self.params)
+
+    def close(self):
+        if not self.connection.closed:
+            self.connection.close()
+
+
+class AsyncDBProvider(DBProvider):
+    """
+    Database built from a catalog fetched by the AsyncIntrospectionEngine.
+    """
+
+    def __init__(self, db_connection, catalog, ignore_columns=None, ignore_tables=None):
+        self.db_connection = db_connection
+        self.database = Database(db_connection, ignore_columns=ignore_columns, ignore_tables=ignore_tables,
+                                 catalog=catalog)
+        self.database.compute_fingerprint()
+
+    def get_database(self):
+        return self.database
+
+
+class AsyncIntrospectionEngine(object):
+    """
+    Introspects many databases at once from a single thread, multiplexing their connections with poll() instead of
+    blocking one thread per database.
+    """
+
+    def __init__(self, max_in_flight=200, timeout=None, ignore_columns=None, ignore_tables=None,
+                 schema_name='public', statement_timeout=None, lock_timeout=None):
+        """
+        :param max_in_flight: maximum number of databases being introspected at the same time
+        :param timeout: seconds after which an unfinished introspection is abandoned
+        :param statement_timeout: seconds after which the server cancels an introspection query
+        :param lock_timeout: seconds after which the server stops waiting for a lock
+        """
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.statement_timeout = statement_timeout
+        self.lock_timeout = lock_timeout
+        self.ignore_columns = ignore_columns
+        self.ignore_tables = ignore_tables
+        self.schema_name = schema_name
+
+    def introspect(self, connection_configs):
+        """
+        Introspect the databases of the given ConnectionConfigs.
+
+        :return: a generator of (connection_config, provider, error) tuples, in the order introspections finish.
+                 provider is an AsyncDBProvider, or None if introspection failed with error.
+        """
+        pending = deque(connection_configs)
+        in_flight = dict()
+        poller = select.poll()
+
+        while pending or in_flight:
+            ready = list()
+            while pending and len(in_flight) < self.max_in_flight:
+                config = pending.popleft()
+                try:
+                    introspection = AsyncIntrospection(DBConnection(host=config.host,
+                                                                    database=config.database,
+                                                                    user=config.user,
+                                                                    password=config.password,
+                                                                    port=config.port,
+                                                                    statement_timeout=self.statement_timeout,
+                                                                    lock_timeout=self.lock_timeout),
+                                                       ignore_columns=self.ignore_columns,
+                                                       ignore_tables=self.ignore_tables,
+                                                       schema_name=self.schema_name)
+                except Exception, e:
+                    yield config, None, e
+                    continue
+                in_flight[introspection.fileno()] = (config, introspection)
+                ready.append(introspection.fileno())
+
+            ready.extend(fd for fd, event in poller.poll(0 if ready else 1000))
+            if self.timeout is not None:
+                now = time.time()
+                ready.extend(fd for fd, (_, introspection) in in_flight.iteritems()
+                             if now - introspection.started > self.timeout)
+
+            for fd in ready:
+                if fd not in in_flight:
+                    continue
+                config, introspection = in_flight[fd]
+                try:
+                    if self.timeout is not None and time.time() - introspection.started > self.timeout:
+                        raise DeadlineExceeded("Introspection timed out after %ss" % self.timeout)
+                    state = introspection.poll()
+                except Exception, e:
+                    self._finish(poller, in_flight, fd)
+                    yield config, None, e
+                    continue
+
+                if state == POLL_OK:
+                    self._finish(poller, in_flight, fd)
+                    try:
+                        provider = AsyncDBProvider(introspection.db_connection, introspection.catalog,
+                                                   ignore_columns=self.ignore_columns,
+                                                   ignore_tables=self.ignore_tables)
+                    except Exception, e:
+                        yield config, None, e
+                        continue
+                    yield config, provider, None
+                elif state == POLL_READ:
+                    poller.register(fd, select.POLLIN)
+                elif state == POLL_WRITE:
+                    poller.register(fd, select.POLLOUT)
+
+    def _finish(self, poller, in_flight, fd):
+        config, introspection = in_flight.pop(fd)
+        try:
+            poller.unregister(fd)
+        except KeyError:
+            pass
+        introspection.close()
@@ -0,0 +1,198 @@
+"""
+Offline benchmarks of the compare and transform pipeline, on synthetic schemas that need no Postgres.
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+from collections import OrderedDict
+
+from lib.catalog import SchemaCatalog
+from lib.pg_objects import DBConnection, Database, Column
+from lib.pg_transform import PGTransform
+from lib.snapshot import Snapshot, write_snapshot
+from lib.strategy import Strategy
+from lib.util import get_subclasses, pickle_database, unpickle_database
+from lib.writer import SQLightWriter, STDOUTWriter
+
+DATA_TYPES = (('integer', 'int4', None, 32), ('bigint', 'int8', None, 64), ('text', 'text', None, None),
+              ('character varying', 'varchar', 255, None), ('boolean', 'bool', None, None))
+
+
+class SchemaSpec(object):
+    """
+    Shape of a synthetic schema. drift is the fraction of columns, and a tenth of that the fraction of tables, that
+    differ from the reference schema.
+    """
+
+    def __init__(self, tables=200, columns=20, triggers=2, constraints=3, indexes=2, procedures=20, drift=0.05,
+                 seed=0):
+        self.tables = tables
+        self.columns = columns
+        self.triggers = triggers
+        self.constraints = constraints
+        self.indexes = indexes
+        self.procedures = procedures
+        self.drift = drift
+        self.seed = seed
+
+    def as_dict(self):
+        return OrderedDict(sorted(self.__dict__.iteritems()))
+
+
+def synthetic_database(name, spec, drift=0.0):
+    """
+    Build a Database from a synthetic catalog. Databases built with the same spec are equal, except for the
+    differences drift introduces.
+    """
+    rng = random.Random(spec.seed)
+    catalog = SchemaCatalog(name)
+    table_names = ['table_%05d' % t for t in xrange(spec.tables)]
+    table_names.extend('extra_%05d' % t for t in xrange(int(round(spec.tables * drift / 10))))
+    for table_name in table_names:
+        if drift and rng.random() < drift / 10:
+            continue
+        catalog.add_rows('tables', [dict(table_name=table_name, table_schema='public', table_type='BASE TABLE',
+                                         table_catalog=name)], table_name=table_name)
+        catalog.add_rows('columns', synthetic_columns(spec, rng, drift), table_name=table_name)
+        catalog.add_rows('constraints', synthetic_constraints(table_name, spec), table_name=table_name)
+        catalog.add_rows('triggers', [dict(trigger_name='trigger_%d' % i, event_object_table=table_name,
+                                           action_order=i + 1, action_statement='EXECUTE PROCEDURE f_%d()' % i,
+                                           action_orientation='ROW', action_timing='BEFORE')
+                                      for i in xrange(spec.triggers)], table_name=table_name)
+        catalog.add_rows('indexes', [dict(table_name=table_name, column_name='column_%03d' % i)
+                                     for i in xrange(min(spec.indexes, spec.columns))], table_name=table_name)
+        catalog.add_rows('foreign_keys', [], table_name=table_name)
+    catalog.add_rows('procedures', [dict(name='f_%d' % i, num_args=0, return_type='trigger', language_type='plpgsql',
+                                         argument_types_oids='', body='BEGIN RETURN NEW; END;')
+                                    for i in xrange(spec.procedures)])
+    database = Database(DBConnection(host=None, database=name, user=None, password=None), catalog=catalog)
+    database.compute_fingerprint()
+    return database
+
+
+def synthetic_columns(spec, rng, drift):
+    columns = list()
+    for i in xrange(spec.columns):
+        data_type, udt_name, length, precision = DATA_TYPES[i % len(DATA_TYPES)]
+        column = dict(column_name='column_%03d' % i, data_type=data_type, udt_name=udt_name,
+                      column_default=None, is_nullable='NO' if i == 0 else 'YES',
+                      character_maximum_length=length, numeric_precision=precision)
+        if drift and rng.random() < drift:
+            change = rng.choice(('nullable', 'type', 'default', 'missing'))
+            if change == 'missing':
+                continue
+            elif change == 'nullable':
+                column['is_nullable'] = 'YES' if column['is_nullable'] == 'NO' else 'NO'
+            elif change == 'type':
+                column['data_type'], column['udt_name'] = 'numeric', 'numeric'
+            else:
+                column['column_default'] = "'drifted'::text"
+        columns.append(column)
+    return columns
+
+
+def synthetic_constraints(table_name, spec):
+    constraints = list()
+    for i in xrange(spec.constraints):
+        constraint_type = ('PRIMARY KEY', 'UNIQUE', 'CHECK')[min(i, 2)]
+        constraints.append(dict(constraint_name='%s_constraint_%d' % (table_name, i),
+                                constraint_type=constraint_type, is_deferrable='NO', is_deferred='NO',
+                                table_name=table_name))
+    return constraints
+
+
+class OfflineProvider(object):
+    """
+    Provider for PGTransform that never connects.
+    """
+
+    class db_connection(object):
+        connection = None
+
+
+class Benchmark(object):
+    def __init__(self, spec, repeat=5):
+        self.spec = spec
+        self.repeat = repeat
+        self.results = OrderedDict()
+
+    def run(self):
+        """
+        Time every case.
+
+        :return: a JSON serializable dict of the spec, the number of differences and, for every case, the minimum and
+                 median run time in seconds
+        """
+        work_dir = tempfile.mkdtemp(prefix='pg-benchmark-')
+        try:
+            reference = synthetic_database('reference', self.spec)
+            target = synthetic_database('target', self.spec, drift=self.spec.drift)
+            diffs = reference.compare_to(target)
+            transformer = PGTransform(OfflineProvider(), diffs, config=None, target_name='target',
+                                      strategies=[strategy_class() for strategy_class in
+                                                  get_subclasses(package='strategies', BaseClass=Strategy)
+                                                  if 'target' in strategy_class.__dict__])
+            pickle_path = os.path.join(work_dir, 'reference.pickle')
+            snapshot_path = os.path.join(work_dir, 'reference.snapshot')
+            sqlite_path = os.path.join(work_dir, 'diffs.sqlite')
+
+            self.time('compare_to', lambda: reference.compare_to(target))
+            self.time('iter_diffs', lambda: sum(1 for _ in reference.iter_diffs(target)))
+            self.time('findall', lambda: diffs.findall(Column, attribute='object_type'))
+            self.time('get_target_nodes', lambda: [transformer.get_target_nodes(strategy)
+                                                   for strategy in transformer.strategies])
+            self.time('pickle_save', lambda: pickle_database(reference, pickle_path))
+            self.time('pickle_load', lambda: unpickle_database(pickle_path))
+            self.time('snapshot_save', lambda: write_snapshot(reference, snapshot_path))
+            self.time('snapshot_load', lambda: self.load_snapshot(snapshot_path, load_all=False))
+            self.time('snapshot_load_all', lambda: self.load_snapshot(snapshot_path, load_all=True))
+            self.time('stdout_writer', lambda: self.write_stdout(diffs))
+            self.time('sqlite_writer', lambda: SQLightWriter(sqlite_path, 'target').write(diffs))
+            diff_count = sum(1 for _ in reference.iter_diffs(target))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return OrderedDict([('spec', self.spec.as_dict()), ('diff_count', diff_count), ('results', self.results)])
+
+    def time(self, case, func):
+        times = sorted(timeit.Timer(func).repeat(repeat=self.repeat, number=1))
+        self.results[case] = OrderedDict([('min', times[0]), ('median', times[len(times) // 2])])
+
+    def load_snapshot(self, snapshot_path, load_all):
+        with Snapshot(snapshot_path) as snapshot:
+            database = snapshot.get_database()
+            if load_all:
+                for table in database.tables:
+                    table.load()
+
+    def write_stdout(self, diffs):
+        # Time the rendering and printing, not the terminal
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            STDOUTWriter().write(diffs)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    :return: a list of (case, baseline median, median) for every case more than tolerance slower than the baseline
+    """
+    regressions = list()
+    for case, timing in results['results'].iteritems():
+        baseline_timing = baseline['results'].get(case)
+        if baseline_timing is None:
+            continue
+        if timing['median'] > baseline_timing['median'] * (1 + tolerance):
+            regressions.append((case, baseline_timing['median'], timing['median']))
+    return regressions
+
+
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
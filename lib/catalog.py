@@ -0,0 +1,401 @@
+from collections import OrderedDict, namedtuple
+
+from lib.metrics import metrics
+
+# What to introspect: the names of the tables, and the kinds of catalog objects as in SchemaCatalog.bulk_queries.
+# None stands for all of them.
+IntrospectionScope = namedtuple('IntrospectionScope', ['tables', 'kinds'])
+
+
+class SchemaCatalog(object):
+    """
+    Raw catalog rows for a schema, grouped by the table they belong to.
+
+    In bulk mode every kind of object is fetched for the whole schema with a single query and the rows are split
+    into tables on the client, instead of running one query per kind for every table.
+    """
+
+    # Restricts a bulk query to a subset of tables when 'tables' is given
+    _TABLE_FILTER = "(%%(tables)s::text[] IS NULL OR %s::text = ANY (%%(tables)s::text[]))"
+
+    SQL_SELECT_TABLES = """
+    SELECT table_name AS catalog_table, *
+    FROM information_schema.tables
+    WHERE
+      table_schema = %%(schema_name)s
+    AND
+      NOT table_name ILIKE ANY (%%(ignore_tables)s)
+    AND
+      %s
+    ORDER BY table_name
+    """ % (_TABLE_FILTER % 'table_name')
+
+    # Equivalent to information_schema.columns, but without the overhead of the view
+    SQL_SELECT_COLUMNS = """
+    SELECT
+      c.relname AS catalog_table,
+      a.attname AS column_name,
+      CASE WHEN t.typtype = 'd' THEN
+        CASE WHEN bt.typelem <> 0 AND bt.typlen = -1 THEN 'ARRAY'
+             WHEN nbt.nspname = 'pg_catalog' THEN format_type(t.typbasetype, NULL)
+             ELSE 'USER-DEFINED'
+        END
+      ELSE
+        CASE WHEN t.typelem <> 0 AND t.typlen = -1 THEN 'ARRAY'
+             WHEN nt.nspname = 'pg_catalog' THEN format_type(a.atttypid, NULL)
+             ELSE 'USER-DEFINED'
+        END
+      END AS data_type,
+      coalesce(bt.typname, t.typname) AS udt_name,
+      pg_get_expr(ad.adbin, ad.adrelid) AS column_default,
+      CASE WHEN a.attnotnull OR (t.typtype = 'd' AND t.typnotnull) THEN 'NO' ELSE 'YES' END AS is_nullable,
+      information_schema._pg_char_max_length(information_schema._pg_truetypid(a, t),
+                                             information_schema._pg_truetypmod(a, t)) AS character_maximum_length,
+      information_schema._pg_numeric_precision(information_schema._pg_truetypid(a, t),
+                                               information_schema._pg_truetypmod(a, t)) AS numeric_precision
+    FROM pg_attribute a
+      JOIN pg_class c ON a.attrelid = c.oid
+      JOIN pg_namespace nc ON c.relnamespace = nc.oid
+      JOIN pg_type t ON a.atttypid = t.oid
+      JOIN pg_namespace nt ON t.typnamespace = nt.oid
+      LEFT JOIN pg_attrdef ad ON a.attrelid = ad.adrelid AND a.attnum = ad.adnum
+      LEFT JOIN (pg_type bt JOIN pg_namespace nbt ON bt.typnamespace = nbt.oid)
+        ON t.typtype = 'd' AND t.typbasetype = bt.oid
+    WHERE
+      nc.nspname = %%(schema_name)s
+    AND
+      c.relkind IN ('r', 'v', 'f', 'p')
+    AND
+      a.attnum > 0
+    AND
+      NOT a.attisdropped
+    AND
+      (pg_has_role(c.relowner, 'USAGE')
+       OR has_column_privilege(c.oid, a.attnum, 'SELECT, INSERT, UPDATE, REFERENCES'))
+    AND
+      NOT a.attname ILIKE ANY (%%(ignore_columns)s)
+    AND
+      %s
+    ORDER BY c.relname, a.attnum
+    """ % (_TABLE_FILTER % 'c.relname')
+
+    SQL_SELECT_CONSTRAINTS = """
+    SELECT t.relname AS catalog_table,
+           c.conname AS constraint_name,
+           CASE c.contype
+           WHEN 'c' THEN 'CHECK'
+           WHEN 'f' THEN 'FOREIGN KEY'
+           WHEN 'p' THEN 'PRIMARY KEY'
+           WHEN 'u' THEN 'UNIQUE'
+           END AS "constraint_type",
+           CASE WHEN c.condeferrable = 'f' THEN 'NO' ELSE 'YES' END AS is_deferrable,
+           CASE WHEN c.condeferred = 'f' THEN 'NO' ELSE 'YES' END AS is_deferred,
+           t.relname AS table_name,
+           CASE confupdtype
+           WHEN 'a' THEN 'NO ACTION'
+           WHEN 'r' THEN 'RESTRICT'
+           WHEN 'c' THEN 'CASCADE'
+           WHEN 'n' THEN 'SET NULL'
+           WHEN 'd' THEN 'SET DEFAULT'
+           END AS on_update,
+           CASE confdeltype
+           WHEN 'a' THEN 'NO ACTION'
+           WHEN 'r' THEN 'RESTRICT'
+           WHEN 'c' THEN 'CASCADE'
+           WHEN 'n' THEN 'SET NULL'
+           WHEN 'd' THEN 'SET DEFAULT'
+           END AS on_delete,
+           CASE confmatchtype
+           WHEN 'u' THEN 'UNSPECIFIED'
+           WHEN 'f' THEN 'FULL'
+           WHEN 'p' THEN 'PARTIAL'
+           END AS match_type,
+           t2.relname AS references_table,
+           array_to_string(c.confkey, ' ') AS fk_constraint_key
+    FROM pg_constraint c
+      JOIN pg_class t ON c.conrelid = t.oid
+      JOIN pg_namespace n ON t.relnamespace = n.oid
+      LEFT JOIN pg_class t2 ON c.confrelid = t2.oid
+    WHERE
+      n.nspname = %%(schema_name)s
+    AND
+      %s
+    ORDER BY t.relname
+    """ % (_TABLE_FILTER % 't.relname')
+
+    # Foreign keys belong to the table they reference, as they do when introspecting table by table
+    SQL_SELECT_FOREIGN_KEYS = """
+    SELECT ccu.table_name AS catalog_table,
+           tc.table_schema,
+           tc.constraint_name,
+           tc.table_name,
+           kcu.column_name,
+           ccu.table_name  AS foreign_table_name,
+           ccu.column_name AS foreign_column_name
+    FROM information_schema.table_constraints tc
+      JOIN information_schema.key_column_usage kcu
+        ON tc.constraint_name = kcu.constraint_name
+      JOIN information_schema.constraint_column_usage ccu
+        ON ccu.constraint_name = tc.constraint_name
+    WHERE
+      tc.constraint_type = 'FOREIGN KEY'
+    AND
+      ccu.table_schema = %%(schema_name)s
+    AND
+      %s
+    ORDER BY ccu.table_name
+    """ % (_TABLE_FILTER % 'ccu.table_name')
+
+    SQL_SELECT_TRIGGERS = """
+    SELECT
+      event_object_table AS catalog_table,
+      trigger_name,
+      event_object_table,
+      action_order,
+      action_condition,
+      action_statement,
+      action_orientation,
+      action_timing,
+      action_reference_old_table,
+      action_reference_new_table,
+      action_reference_new_row,
+      created
+    FROM information_schema.triggers
+    WHERE
+      event_object_schema = %%(schema_name)s
+    AND
+      %s
+    ORDER BY event_object_table
+    """ % (_TABLE_FILTER % 'event_object_table')
+
+    SQL_SELECT_INDEXES = """
+    SELECT
+      t.relname AS catalog_table,
+      t.relname AS table_name,
+      a.attname AS column_name
+    FROM pg_index ix
+      JOIN pg_class t ON t.oid = ix.indrelid
+      JOIN pg_namespace n ON t.relnamespace = n.oid
+      JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY (ix.indkey)
+    WHERE
+      n.nspname = %%(schema_name)s
+    AND
+      t.relkind = 'r'
+    AND
+      NOT a.attname ILIKE ANY (%%(ignore_columns)s)
+    AND
+      %s
+    ORDER BY t.relname
+    """ % (_TABLE_FILTER % 't.relname')
+
+    SQL_SELECT_PROCEDURES = """
+    SELECT
+      p.proname     AS name,
+      p.pronargs    AS num_args,
+      t1.typname    AS return_type,
+      l.lanname     AS language_type,
+      p.proargtypes AS argument_types_oids,
+      prosrc        AS body
+    FROM pg_proc p
+      LEFT JOIN pg_type t1 ON p.prorettype = t1.oid
+      LEFT JOIN pg_language l ON p.prolang = l.oid
+    WHERE proname IN (
+      SELECT routine_name
+      FROM information_schema.routines
+      WHERE specific_schema NOT IN
+            ('pg_catalog', 'information_schema')
+            AND type_udt_name != 'trigger'
+            AND data_type = 'USER-DEFINED'
+    )
+    """
+
+    # One md5 digest per table over its normalized columns, constraints, referencing foreign keys, triggers and
+    # indexed columns. Equal digests mean introspecting both tables gives the same objects.
+    SQL_SELECT_TABLE_DIGESTS = """
+    SELECT
+      c.relname AS table_name,
+      md5(
+        coalesce((SELECT string_agg(a.attname || ' ' || format_type(a.atttypid, a.atttypmod) || ' ' ||
+                                    a.attnotnull || ' ' || coalesce(pg_get_expr(ad.adbin, ad.adrelid), ''),
+                                    ',' ORDER BY a.attname)
+                  FROM pg_attribute a
+                    LEFT JOIN pg_attrdef ad ON a.attrelid = ad.adrelid AND a.attnum = ad.adnum
+                  WHERE a.attrelid = c.oid
+                    AND a.attnum > 0
+                    AND NOT a.attisdropped
+                    AND NOT a.attname ILIKE ANY (%(ignore_columns)s)), '') || '|' ||
+        coalesce((SELECT string_agg(con.conname || ' ' || pg_get_constraintdef(con.oid), ',' ORDER BY con.conname)
+                  FROM pg_constraint con
+                  WHERE con.conrelid = c.oid
+                    AND con.contype IN ('c', 'p', 'u')), '') || '|' ||
+        coalesce((SELECT string_agg(fk.conname || ' ' || r.relname || ' ' || pg_get_constraintdef(fk.oid),
+                                    ',' ORDER BY fk.conname, r.relname)
+                  FROM pg_constraint fk
+                    JOIN pg_class r ON fk.conrelid = r.oid
+                  WHERE fk.confrelid = c.oid
+                    AND fk.contype = 'f'), '') || '|' ||
+        coalesce((SELECT string_agg(tg.tgname || ' ' || pg_get_triggerdef(tg.oid), ',' ORDER BY tg.tgname)
+                  FROM pg_trigger tg
+                  WHERE tg.tgrelid = c.oid
+                    AND NOT tg.tgisinternal), '') || '|' ||
+        coalesce((SELECT string_agg(a.attname, ',' ORDER BY a.attname)
+                  FROM pg_index ix
+                    JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = ANY (ix.indkey)
+                  WHERE ix.indrelid = c.oid
+                    AND NOT a.attname ILIKE ANY (%(ignore_columns)s)), '')
+      ) AS digest
+    FROM pg_class c
+      JOIN pg_namespace n ON c.relnamespace = n.oid
+    WHERE
+      n.nspname = %(schema_name)s
+    AND
+      c.relkind IN ('r', 'v', 'f', 'p')
+    AND
+      NOT c.relname ILIKE ANY (%(ignore_tables)s)
+    ORDER BY c.relname
+    """
+
+    # Changes whenever a catalog row introspection reads is created, altered or dropped: every such row gets a new
+    # xmin, and dropped rows take their oid with them.
+    SQL_SELECT_CHANGE_STAMP = """
+    WITH relations AS (
+      SELECT c.oid
+      FROM pg_class c
+        JOIN pg_namespace n ON c.relnamespace = n.oid
+      WHERE n.nspname = %(schema_name)s
+    )
+    SELECT md5(coalesce(string_agg(stamp, ',' ORDER BY stamp), '')) AS change_stamp
+    FROM (
+      SELECT 'c' || c.oid::text || ':' || c.xmin::text AS stamp
+      FROM pg_class c
+      WHERE c.oid IN (SELECT oid FROM relations)
+      UNION ALL
+      SELECT 'a' || a.attrelid::text || '.' || a.attnum::text || ':' || a.xmin::text
+      FROM pg_attribute a
+      WHERE a.attrelid IN (SELECT oid FROM relations)
+        AND a.attnum > 0
+      UNION ALL
+      SELECT 'd' || ad.oid::text || ':' || ad.xmin::text
+      FROM pg_attrdef ad
+      WHERE ad.adrelid IN (SELECT oid FROM relations)
+      UNION ALL
+      SELECT 'n' || con.oid::text || ':' || con.xmin::text
+      FROM pg_constraint con
+      WHERE con.conrelid IN (SELECT oid FROM relations)
+         OR con.confrelid IN (SELECT oid FROM relations)
+      UNION ALL
+      SELECT 't' || tg.oid::text || ':' || tg.xmin::text
+      FROM pg_trigger tg
+      WHERE tg.tgrelid IN (SELECT oid FROM relations)
+      UNION ALL
+      SELECT 'i' || ix.indexrelid::text || ':' || ix.xmin::text
+      FROM pg_index ix
+      WHERE ix.indrelid IN (SELECT oid FROM relations)
+      UNION ALL
+      SELECT 'p' || p.oid::text || ':' || p.xmin::text
+      FROM pg_proc p
+        JOIN pg_namespace n ON p.pronamespace = n.oid
+      WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+      UNION ALL
+      SELECT 'y' || t.oid::text || ':' || t.xmin::text
+      FROM pg_type t
+        JOIN pg_namespace n ON t.typnamespace = n.oid
+      WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+    ) stamps
+    """
+
+    def __init__(self, database_name):
+        self.database_name = database_name
+        self.rows = dict()
+
+    @property
+    def bulk_queries(self):
+        return [('tables', self.SQL_SELECT_TABLES),
+                ('constraints', self.SQL_SELECT_CONSTRAINTS),
+                ('columns', self.SQL_SELECT_COLUMNS),
+                ('triggers', self.SQL_SELECT_TRIGGERS),
+                ('indexes', self.SQL_SELECT_INDEXES),
+                ('foreign_keys', self.SQL_SELECT_FOREIGN_KEYS),
+                ('procedures', self.SQL_SELECT_PROCEDURES)]
+
+    def fetch(self, cursor, schema_name='public', ignore_columns=None, ignore_tables=None, tables=None, kinds=None):
+        """
+        Fetch the catalog of a whole schema, running a single query for each kind of object.
+
+        :param cursor: a DictCursor on the database to introspect
+        :param tables: only fetch these tables. All tables are fetched when None
+        :param kinds: only fetch these kinds of objects. All kinds are fetched when None
+        :return: self
+        """
+        params = self.query_params(schema_name, ignore_columns, ignore_tables, tables)
+        for kind, sql_select in self.bulk_queries:
+            if kinds is None or kind in kinds:
+                self.add_rows(kind, self.select(cursor, kind, sql_select, params))
+        return self
+
+    def merge(self, other):
+        """
+        Add the rows of another catalog of the same schema, such as one fetched for other tables.
+
+        :return: self
+        """
+        for kind, kind_rows in other.rows.iteritems():
+            for table_name, rows in kind_rows.iteritems():
+                self.rows.setdefault(kind, OrderedDict()).setdefault(table_name, []).extend(rows)
+        return self
+
+    @staticmethod
+    def select(cursor, kind, sql_select, params):
+        """
+        Run the catalog query for a kind of object, recording its time and the number of rows it returned.
+        """
+        with metrics.timer('query.%s' % kind):
+            cursor.execute(sql_select, params)
+            rows = cursor.fetchall()
+        metrics.count('queries')
+        metrics.count('rows', len(rows))
+        return rows
+
+    @staticmethod
+    def query_params(schema_name='public', ignore_columns=None, ignore_tables=None, tables=None):
+        return dict(schema_name=schema_name,
+                    ignore_columns=ignore_columns or [],
+                    ignore_tables=ignore_tables or [],
+                    tables=list(tables) if tables is not None else None)
+
+    @classmethod
+    def select_digests(cls, cursor, schema_name='public', ignore_columns=None, ignore_tables=None):
+        """
+        Select the catalog digest of every table in the schema with a single query.
+
+        :return: an OrderedDict of table name to digest
+        """
+        rows = cls.select(cursor, 'digests', cls.SQL_SELECT_TABLE_DIGESTS,
+                          cls.query_params(schema_name, ignore_columns, ignore_tables))
+        return OrderedDict((row['table_name'], row['digest']) for row in rows)
+
+    @classmethod
+    def select_change_stamp(cls, cursor, schema_name='public'):
+        """
+        Select a stamp of the catalog rows introspection reads, with a single query. Introspecting the schema again
+        gives the same objects as long as the stamp stays the same.
+        """
+        rows = cls.select(cursor, 'change_stamp', cls.SQL_SELECT_CHANGE_STAMP, cls.query_params(schema_name))
+        return rows[0]['change_stamp']
+
+    def add_rows(self, kind, rows, table_name=None):
+        """
+        Add rows of the given kind. Rows are grouped on their catalog_table column, or on table_name if the query
+        did not select one.
+        """
+        kind_rows = self.rows.setdefault(kind, OrderedDict())
+        for row in rows:
+            row = dict(row)
+            kind_rows.setdefault(row.pop('catalog_table', table_name), []).append(row)
+
+    def get(self, kind, table_name=None):
+        return self.rows.get(kind, {}).get(table_name, [])
+
+    @property
+    def table_names(self):
+        return self.rows.get('tables', {}).keys()
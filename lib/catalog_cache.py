@@ -0,0 +1,74 @@
+import hashlib
+import os
+import tempfile
+
+from psycopg2.extras import DictCursor
+
+from lib.catalog import SchemaCatalog
+from lib.exception import SnapshotException
+from lib.snapshot import Snapshot, write_snapshot
+
+
+class CatalogCache(object):
+    """
+    Snapshots of introspected databases on disk, one per database and set of introspection settings. Each snapshot
+    stores the catalog change stamp of its database at the time it was introspected, and is only used while the
+    database still has that stamp.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_database(self, db_connection, build, schema_name='public', ignore_columns=None, ignore_tables=None):
+        """
+        Return the cached Database of db_connection if its schema did not change since it was cached. Otherwise
+        call build() to introspect it, and cache the result.
+
+        :param build: a callable returning a freshly introspected Database
+        :return: a (database, snapshot) tuple. snapshot is the open Snapshot a cached database loads its tables
+                 from, to be closed once the database is no longer used, or None if the database was built
+        """
+        cursor = db_connection.connection.cursor(cursor_factory=DictCursor)
+        try:
+            change_stamp = SchemaCatalog.select_change_stamp(cursor, schema_name=schema_name)
+        finally:
+            cursor.close()
+
+        path = self.get_path(db_connection, schema_name, ignore_columns, ignore_tables)
+        snapshot = self.load(path, change_stamp)
+        if snapshot is not None:
+            return snapshot.get_database(), snapshot
+        database = build()
+        self.store(path, database, change_stamp)
+        return database, None
+
+    def get_path(self, db_connection, schema_name, ignore_columns, ignore_tables):
+        key = repr((db_connection.host, str(db_connection.port), db_connection.user, db_connection.database,
+                    schema_name, sorted(ignore_columns or []), sorted(ignore_tables or [])))
+        return os.path.join(self.cache_dir, hashlib.md5(key).hexdigest() + '.snapshot')
+
+    def load(self, path, change_stamp):
+        if not os.path.exists(path):
+            return None
+        try:
+            snapshot = Snapshot(path)
+        except SnapshotException:
+            # Written by an incompatible version, or cut short. It is replaced with a fresh one.
+            return None
+        if snapshot.meta.get('change_stamp') != change_stamp:
+            snapshot.close()
+            return None
+        return snapshot
+
+    def store(self, path, database, change_stamp):
+        # Write to a temporary file first, so that concurrent runs never read a partial snapshot
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            write_snapshot(database, tmp_path, meta=dict(change_stamp=change_stamp))
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,113 @@
+"""
+Catalog exports: the raw catalog rows of a database, as the bulk introspection queries return them, dumped to a
+file with one COPY per kind of object. Databases can be exported while connections are cheap to hold, and compared
+offline later on as many processes as there are cores.
+
+An export is a text file. Its first line is a JSON header, followed by a '-- <kind>' line for every kind of object
+and then one JSON document per row of that kind.
+"""
+import json
+import os
+import tempfile
+
+from lib.catalog import SchemaCatalog
+from lib.exception import CatalogExportException
+from lib.snapshot import to_str
+
+FORMAT = 'pg-catalog-export'
+VERSION = 1
+KIND_PREFIX = '-- '
+
+# CSV with a quote and delimiter that never appear in JSON output, so every row is copied verbatim. The text format
+# would escape the backslashes of the JSON.
+SQL_COPY_ROWS = """
+COPY (SELECT row_to_json(export_rows) FROM (%s) export_rows)
+TO STDOUT WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')
+"""
+
+
+def export_path(export_dir, host, port, database):
+    """
+    :return: the path the export of a database is written to in export_dir
+    """
+    return os.path.join(export_dir, '%s_%s_%s.catalog' % (host, port, database))
+
+
+def export_catalog(db_connection, out_path, schema_name='public', ignore_columns=None, ignore_tables=None):
+    """
+    Export the catalog of db_connection to out_path. The file is replaced at once, so readers never see a partial
+    export.
+    """
+    params = SchemaCatalog.query_params(schema_name, ignore_columns, ignore_tables)
+    header = dict(format=FORMAT, version=VERSION, database=db_connection.database, schema_name=schema_name,
+                  ignore_columns=params['ignore_columns'], ignore_tables=params['ignore_tables'])
+    cursor = db_connection.connection.cursor()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out_file:
+            out_file.write(json.dumps(header) + '\n')
+            for kind, sql_select in SchemaCatalog(db_connection.database).bulk_queries:
+                out_file.write(KIND_PREFIX + kind + '\n')
+                cursor.copy_expert(SQL_COPY_ROWS % cursor.mogrify(sql_select, params), out_file)
+        os.rename(tmp_path, out_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    finally:
+        cursor.close()
+
+
+def read_catalog_export(path):
+    """
+    :return: the export header and a SchemaCatalog with the exported rows, equal to the one SchemaCatalog.fetch()
+             returns
+    """
+    with open(path, 'rb') as export_file:
+        try:
+            header = to_str(json.loads(export_file.readline()))
+        except ValueError:
+            raise CatalogExportException("%s is not a catalog export" % path)
+        if not isinstance(header, dict) or header.get('format') != FORMAT:
+            raise CatalogExportException("%s is not a catalog export" % path)
+        if header['version'] > VERSION:
+            raise CatalogExportException("%s has export version %s, only up to %s is supported" %
+                                         (path, header['version'], VERSION))
+
+        catalog = SchemaCatalog(header['database'])
+        kind = None
+        rows = list()
+        for line in export_file:
+            if line.startswith(KIND_PREFIX):
+                if kind is not None:
+                    catalog.add_rows(kind, rows)
+                kind = line[len(KIND_PREFIX):].strip()
+                rows = list()
+                continue
+            try:
+                rows.append(export_row(kind, to_str(json.loads(line))))
+            except ValueError, e:
+                raise CatalogExportException("%s is corrupt: %s" % (path, e))
+        if kind is not None:
+            catalog.add_rows(kind, rows)
+    return header, catalog
+
+
+def export_row(kind, row):
+    """
+    Turn a row back into what psycopg2 returns for it.
+    """
+    if kind == 'procedures' and isinstance(row.get('argument_types_oids'), list):
+        # oidvector is an array to row_to_json, and a space separated string to psycopg2
+        row['argument_types_oids'] = ' '.join(str(oid) for oid in row['argument_types_oids'])
+    return row
+
+
+def export_database(db_connection, export_dir, ignore_columns=None, ignore_tables=None):
+    """
+    Export the catalog of db_connection to its path in export_dir.
+
+    :return: the path of the export
+    """
+    out_path = export_path(export_dir, db_connection.host, db_connection.port, db_connection.database)
+    export_catalog(db_connection, out_path, ignore_columns=ignore_columns, ignore_tables=ignore_tables)
+    return out_path
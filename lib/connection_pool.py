@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import defaultdict
+
+# Returned by _reserve() when the host is at its cap and the caller does not wait
+_FULL = object()
+
+
+def host_of(key):
+    """
+    The (host, port) of a pool key, as item_host() gives for the items of a run.
+    """
+    return key[:2]
+
+
+class ConnectionPool(object):
+    """
+    Keeps connections open between uses, keyed by host, port, user and database, so a database that is connected to
+    more than once in a run only pays for connection setup once. The number of connections open to a single host,
+    idle or in use, can be capped. Hosts are told apart by host and port, as the scheduler does, so Postgres
+    instances on different ports of one machine have a cap each.
+    """
+
+    def __init__(self, max_idle_time=300, max_per_host=None):
+        """
+        :param max_idle_time: seconds after which an idle connection is closed
+        :param max_per_host: maximum number of connections open to one host. Unlimited when None
+        """
+        self.max_idle_time = max_idle_time
+        self.max_per_host = max_per_host
+        self._idle = defaultdict(list)
+        self._open = defaultdict(int)
+        self._condition = threading.Condition()
+
+    def acquire(self, db_connection, block=True):
+        """
+        Return a healthy connection for db_connection, reusing an idle one if possible. Blocks while the host of
+        db_connection is at its cap, or returns None then if block is False.
+        """
+        key = self.get_key(db_connection)
+        while True:
+            conn = self._reserve(key, block)
+            if conn is _FULL:
+                return None
+            if conn is None:
+                try:
+                    return db_connection.connect()
+                except Exception:
+                    self._discard(key)
+                    raise
+            if self.is_healthy(conn):
+                return conn
+            self._close(conn)
+            self._discard(key)
+
+    def release(self, db_connection, conn):
+        """
+        Return a connection to the pool. Any open transaction is rolled back.
+        """
+        key = self.get_key(db_connection)
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except Exception:
+            self._close(conn)
+        if conn.closed:
+            self._discard(key)
+            return
+        with self._condition:
+            self._idle[key].append((conn, time.time()))
+            self._condition.notify_all()
+
+    def close_all(self):
+        with self._condition:
+            for key, idle in self._idle.items():
+                for conn, _ in idle:
+                    self._close(conn)
+                    self._open[host_of(key)] -= 1
+            self._idle.clear()
+            self._condition.notify_all()
+
+    def is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def get_key(self, db_connection):
+        return db_connection.host, db_connection.port, db_connection.user, db_connection.database
+
+    def _reserve(self, key, block=True):
+        """
+        Pop an idle connection for key, or reserve a slot for a new one on the host and return None. Returns _FULL
+        if there is no room on the host and block is False.
+        """
+        host = host_of(key)
+        with self._condition:
+            while True:
+                self._expire()
+                if self._idle[key]:
+                    conn, _ = self._idle[key].pop()
+                    return conn
+                if self.max_per_host is None or self._open[host] < self.max_per_host:
+                    self._open[host] += 1
+                    return None
+                if not self._close_idle_on_host(host):
+                    if not block:
+                        return _FULL
+                    self._condition.wait(1)
+
+    def _discard(self, key):
+        with self._condition:
+            self._open[host_of(key)] -= 1
+            self._condition.notify_all()
+
+    def _expire(self):
+        now = time.time()
+        for key, idle in self._idle.items():
+            for conn, idle_since in list(idle):
+                if now - idle_since > self.max_idle_time:
+                    idle.remove((conn, idle_since))
+                    self._close(conn)
+                    self._open[host_of(key)] -= 1
+
+    def _close_idle_on_host(self, host):
+        """
+        Close the longest idle connection to another database on host, to make room under the cap.
+        """
+        candidates = [(idle_since, key, conn) for key, idle in self._idle.iteritems() if host_of(key) == host
+                      for conn, idle_since in idle]
+        if not candidates:
+            return False
+        idle_since, key, conn = min(candidates)
+        self._idle[key].remove((conn, idle_since))
+        self._close(conn)
+        self._open[host] -= 1
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,145 @@
+"""
+Wall clock deadlines for the work done on a database.
+
+Work runs inside deadlines.deadline(seconds, name). Connections opened on that thread register with the deadline,
+and a watchdog thread cancels their running query once it expires. The work then fails with DeadlineExceeded.
+Work that runs no query, such as comparing, calls deadlines.check() between steps instead.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import errorcodes
+
+from lib.exception import DeadlineExceeded
+from lib.metrics import metrics
+from lib.util import print_warn
+
+# SQLSTATEs of queries cancelled by statement_timeout, and of waits for a lock ended by lock_timeout
+TIMEOUT_CODES = (errorcodes.QUERY_CANCELED, errorcodes.LOCK_NOT_AVAILABLE)
+
+
+def is_timeout(error):
+    """
+    Whether error is a deadline, statement or lock timeout, after which a database is worth another try. Other
+    errors, such as failed authentication or a missing database, are not.
+    """
+    return isinstance(error, DeadlineExceeded) or (isinstance(error, psycopg2.Error)
+                                                   and error.pgcode in TIMEOUT_CODES)
+
+
+class Deadline(object):
+    def __init__(self, name, seconds):
+        self.name = name
+        self.seconds = seconds
+        self.expires = time.time() + seconds
+        self.expired = False
+        self.connections = list()
+
+
+class Deadlines(object):
+    def __init__(self, interval=0.5):
+        """
+        :param interval: seconds between checks of the watchdog thread
+        """
+        self.interval = interval
+        self.active = set()
+        self.lock = threading.RLock()
+        self.current = threading.local()
+        self.watchdog = None
+
+    @contextmanager
+    def deadline(self, seconds, name):
+        """
+        Cancel the queries of connections opened in the block once it runs for more than seconds. No deadline when
+        seconds is None.
+        """
+        if not seconds:
+            yield
+            return
+        deadline = Deadline(name, seconds)
+        with self.lock:
+            self.active.add(deadline)
+            self._start_watchdog()
+        self.current.deadline = deadline
+        try:
+            yield
+        except Exception:
+            if deadline.expired:
+                raise DeadlineExceeded("%s did not finish within %ss" % (name, seconds))
+            raise
+        finally:
+            self.current.deadline = None
+            with self.lock:
+                self.active.discard(deadline)
+
+    def watch(self, db_connection):
+        """
+        Cancel the queries of db_connection when the deadline of the calling thread expires.
+        """
+        deadline = getattr(self.current, 'deadline', None)
+        if deadline is None:
+            return
+        with self.lock:
+            deadline.connections.append(db_connection)
+            if deadline.expired:
+                db_connection.cancel()
+
+    def unwatch(self, db_connection):
+        """
+        Stop cancelling the queries of db_connection. Hold lock while detaching its connection as well, so the
+        watchdog can not cancel the query of whoever gets that connection next.
+        """
+        with self.lock:
+            for deadline in self.active:
+                if db_connection in deadline.connections:
+                    deadline.connections.remove(db_connection)
+
+    def check(self):
+        """
+        Raise DeadlineExceeded if the deadline of the calling thread has expired.
+        """
+        deadline = getattr(self.current, 'deadline', None)
+        if deadline is not None and (deadline.expired or time.time() > deadline.expires):
+            deadline.expired = True
+            raise DeadlineExceeded("%s did not finish within %ss" % (deadline.name, deadline.seconds))
+
+    def _start_watchdog(self):
+        if self.watchdog is None or not self.watchdog.is_alive():
+            self.watchdog = threading.Thread(target=self._watch, name='Deadlines')
+            self.watchdog.daemon = True
+            self.watchdog.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            with self.lock:
+                for deadline in self.active:
+                    if not deadline.expired and now > deadline.expires:
+                        deadline.expired = True
+                        for db_connection in deadline.connections:
+                            db_connection.cancel()
+
+
+def run_with_deadline(func, name, seconds=None, retries=0, backoff=1.0):
+    """
+    Call func() within a deadline. If it fails with a timeout, see is_timeout(), it is retried up to retries times,
+    waiting backoff seconds before the first retry and twice as long before every next one.
+    """
+    for attempt in xrange(retries + 1):
+        try:
+            with deadlines.deadline(seconds, name):
+                return func()
+        except Exception, e:
+            if attempt == retries or not is_timeout(e):
+                raise
+            delay = backoff * 2 ** attempt
+            print_warn("Retrying: ", "%s in %ss, after: %s" % (name, delay, str(e).strip()))
+            metrics.count('retries')
+            time.sleep(delay)
+
+
+# The deadlines of this process
+deadlines = Deadlines()
@@ -1,3 +1,6 @@
+from collections import defaultdict
+
+
 class DiffItem(object):
     def __init__(self, name, expected, found):
         self.name = name
@@ -66,17 +69,10 @@ class DiffNode(object):
                 self.append(child)
 
     def to_tree(self, level=0):
-        indent_width = '    '
-        indent = indent_width * level
-        output = "%s%s:\n" % (indent, self.name)
+        output = branch_line(self.name, level)
         for child in self.children:
             if child.isleaf():
-                output += "%s -> %s: " \
-                          "expected: %s, " \
-                          "found: %s\n" % ((indent + indent_width),
-                                           repr(child.data),
-                                           repr(child.data.expected),
-                                           repr(child.data.found))
+                output += leaf_line(child, level + 1)
             else:
                 output += child.to_tree(level + 1)
         return output
@@ -86,3 +82,108 @@ class DiffNode(object):
 
     def __repr__(self):
         return "{%s}" % self.name
+
+
+INDENT_WIDTH = '    '
+
+
+def branch_line(name, level):
+    return "%s%s:\n" % (INDENT_WIDTH * level, name)
+
+
+def leaf_line(node, level):
+    return "%s -> %s: " \
+           "expected: %s, " \
+           "found: %s\n" % (INDENT_WIDTH * level,
+                            repr(node.data),
+                            repr(node.data.expected),
+                            repr(node.data.found))
+
+
+def build_tree(name, diff_stream):
+    """
+    Build a DiffNode tree named name from a stream of (path, leaf) differences. Every object on a path gets its own
+    branch node, named after the object.
+    """
+    root = DiffNode(name=name)
+    branches = dict()
+    for path, leaf in diff_stream:
+        parent = root
+        for i, obj in enumerate(path):
+            # Objects, not names, identify branches: objects can share a name
+            key = tuple(id(o) for o in path[:i + 1])
+            if key not in branches:
+                branches[key] = DiffNode(name=obj.name)
+                parent.append(branches[key])
+            parent = branches[key]
+        parent.append(leaf)
+    return root
+
+
+def iter_tree(node, path=()):
+    """
+    Generate the (path, leaf) differences of a DiffNode tree, the reverse of build_tree(). The path is made of
+    DiffNodes.
+    """
+    for child in node.children:
+        if child.isleaf():
+            yield path, child
+        else:
+            for diff in iter_tree(child, path + (child,)):
+                yield diff
+
+
+def iter_tree_lines(name, diff_stream):
+    """
+    Generate the lines DiffNode.to_tree() gives for the tree build_tree() would build, without building it.
+    """
+    open_path = None
+    for path, leaf in diff_stream:
+        keys = tuple(id(o) for o in path)
+        if open_path is None:
+            yield branch_line(name, 0)
+            open_path = ()
+        common = 0
+        while common < min(len(open_path), len(keys)) and open_path[common] == keys[common]:
+            common += 1
+        for level in xrange(common, len(path)):
+            yield branch_line(path[level].name, level + 1)
+        yield leaf_line(leaf, len(path) + 1)
+        open_path = keys
+
+
+class DiffIndex(object):
+    """
+    Index of the nodes of a difference tree by the value of an attribute, optionally restricted to a table and or a
+    column. Built with a single walk of the tree, after which every lookup is a dict access.
+
+    The table of a node is the name of its ancestor directly below the root, and its column the name of its ancestor
+    one level further down. Nodes on those levels are their own table or column.
+    """
+
+    def __init__(self, root, attributes=('name', 'object_type')):
+        self.attributes = attributes
+        self.nodes = defaultdict(list)
+        self._add(root, depth=0, table=None, column=None)
+
+    def find(self, target, attribute='name', table=None, column=None):
+        """
+        :return: the nodes whose attribute equals target, in tree order. If table or column are given, only nodes of
+                 that table or column are returned.
+        """
+        if attribute not in self.attributes:
+            raise ValueError("DiffNode attribute %s is not indexed" % attribute)
+        return self.nodes.get((attribute, target, table, column), [])
+
+    def _add(self, node, depth, table, column):
+        if depth == 1:
+            table = node.name
+        elif depth == 2:
+            column = node.name
+        for attribute in self.attributes:
+            value = getattr(node, attribute)
+            for key in set([(attribute, value, None, None), (attribute, value, table, None),
+                            (attribute, value, None, column), (attribute, value, table, column)]):
+                self.nodes[key].append(node)
+        for child in node.children:
+            self._add(child, depth + 1, table, column)
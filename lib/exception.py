@@ -4,3 +4,23 @@ class StrategyException(Exception):
 
 class ConfigException(Exception):
     """ Raised when there is a config related error """
+
+
+class SnapshotException(Exception):
+    """ Raised when a snapshot file can not be read """
+
+
+class PlanException(Exception):
+    """ Raised when strategies can not be turned into a plan """
+
+
+class CatalogExportException(Exception):
+    """ Raised when a catalog export file can not be read """
+
+
+class JournalException(Exception):
+    """ Raised when a journal can not be used for a run """
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when the work on a database does not finish within its deadline """
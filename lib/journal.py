@@ -0,0 +1,210 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from lib.exception import JournalException
+from lib.scheduler import item_key
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def journal_key(item):
+    """
+    The key of an item in the journal. Items may also be given by their key, as QueuedWriter.finish() and
+    Journal.claim() pass them.
+    """
+    return item if isinstance(item, basestring) else item_key(item)
+
+
+class Journal(object):
+    """
+    Progress of a run, one row per database, in a SQLite file. A database is pending until it is processed, running
+    while it is, and then done or failed. Databases still running when a run was interrupted stay running. Everything
+    that is not done can be processed again with unfinished().
+
+    The file is opened separately by every process that uses the journal, so worker processes can record progress
+    themselves. The journal also serves as a work queue: workers, on one host or on several sharing the file, claim()
+    the databases they process one at a time. It uses the rollback journal rather than WAL, as WAL does not work on
+    network filesystems.
+    """
+
+    SQL_CREATE_TABLE_JOURNAL = """
+    CREATE TABLE IF NOT EXISTS journal (
+        program TEXT NOT NULL,
+        database TEXT NOT NULL,
+        state TEXT NOT NULL,
+        outcome TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        started REAL,
+        finished REAL,
+        worker TEXT,
+        claim TEXT,
+        priority REAL,
+        PRIMARY KEY (program, database)
+    )
+    """
+
+    # Columns added after the first version of the journal
+    ADDED_COLUMNS = (('worker', 'TEXT'), ('claim', 'TEXT'), ('priority', 'REAL'))
+
+    SQL_UPDATE_PRIORITY = """
+    UPDATE journal SET priority = ? WHERE program = ? AND database = ?
+    """
+
+    # A single statement, so no two workers can claim the same database. Databases that were claimed more than a
+    # lease ago are claimed again, as their worker is assumed to be gone.
+    SQL_CLAIM = """
+    UPDATE journal SET state = 'running', worker = ?, claim = ?, started = ?, finished = NULL
+    WHERE program = ? AND database = (
+      SELECT database FROM journal
+      WHERE program = ? AND (state = 'pending' OR (state = 'running' AND started < ?))%(excluded_hosts)s
+      ORDER BY priority IS NOT NULL, priority DESC
+      LIMIT 1
+    )
+    """
+
+    # Keys start with host:port/, see item_key()
+    SQL_EXCLUDE_HOST = """
+      AND substr(database, 1, ?) != ?"""
+
+    SQL_SELECT_CLAIM = """
+    SELECT database FROM journal WHERE program = ? AND claim = ?
+    """
+
+    SQL_INSERT_PENDING = """
+    INSERT OR IGNORE INTO journal (program, database, state) VALUES (?, ?, 'pending')
+    """
+
+    SQL_RESET = """
+    UPDATE journal SET state = 'pending', outcome = NULL, attempts = 0, started = NULL, finished = NULL
+    WHERE program = ?
+    """
+
+    SQL_RESET_FAILED = """
+    UPDATE journal SET state = 'pending', outcome = NULL, started = NULL, finished = NULL
+    WHERE program = ? AND state = 'failed'
+    """
+
+    SQL_SELECT_STATES = """
+    SELECT database, state FROM journal WHERE program = ?
+    """
+
+    SQL_UPDATE_RUNNING = """
+    UPDATE journal SET state = 'running', outcome = NULL, attempts = attempts + 1, started = ?, finished = NULL
+    WHERE program = ? AND database = ?
+    """
+
+    SQL_UPDATE_FINISHED = """
+    UPDATE journal SET state = ?, outcome = ?, finished = ? WHERE program = ? AND database = ?
+    """
+
+    def __init__(self, path, program):
+        """
+        :param program: name of the program the run is for, so pg-compare and pg-transform can share a journal
+        """
+        self.path = path
+        self.program = program
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            # Connections can not be shared with forked processes
+            self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._connection.execute(self.SQL_CREATE_TABLE_JOURNAL)
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(journal)")]
+            for column, column_type in self.ADDED_COLUMNS:
+                if column not in columns:
+                    self._connection.execute("ALTER TABLE journal ADD COLUMN %s %s" % (column, column_type))
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def start(self, items, resume=False):
+        """
+        Record the items of a run as pending, forgetting the progress of earlier runs unless resuming.
+
+        :return: the items to process: all of them, or only those that are not done when resuming
+        """
+        with self._lock:
+            if not resume:
+                self.connection.execute(self.SQL_RESET, (self.program,))
+            self.connection.executemany(self.SQL_INSERT_PENDING, [(self.program, item_key(item)) for item in items])
+            self.connection.commit()
+        if not resume:
+            return list(items)
+        return self.unfinished(items)
+
+    def add(self, items, expected=None, resume=False):
+        """
+        Record the items that are not in the journal yet as pending, keeping the progress of the others. Workers
+        call this with the items they know of, so the first worker to start fills the queue.
+
+        A journal in which every database is done or failed is from a run that finished, and is refused unless
+        resuming it. The failed databases are then pending again.
+
+        :param expected: dict of item_key() to expected duration. Longer databases are claimed first, and those
+                         without an expected duration before all others.
+        :raise JournalException: for the journal of a finished run, when not resuming
+        """
+        expected = expected or dict()
+        keys = [item_key(item) for item in items]
+        with self._lock:
+            states = dict(self.connection.execute(self.SQL_SELECT_STATES, (self.program,)).fetchall())
+            if resume:
+                self.connection.execute(self.SQL_RESET_FAILED, (self.program,))
+            elif states and all(state in (DONE, FAILED) for state in states.itervalues()):
+                raise JournalException("%s is the journal of a finished %s run. Start a new run with a new journal "
+                                       "file, or pass --resume to process the failed databases again"
+                                       % (self.path, self.program))
+            self.connection.executemany(self.SQL_INSERT_PENDING, [(self.program, key) for key in keys])
+            self.connection.executemany(self.SQL_UPDATE_PRIORITY, [(expected[key], self.program, key)
+                                                                   for key in keys if key in expected])
+            self.connection.commit()
+
+    def claim(self, worker, lease, excluded_hosts=()):
+        """
+        Claim the next database to process for worker.
+
+        :param lease: seconds after which a database that is still running is claimed again
+        :param excluded_hosts: (host, port) tuples of hosts not to claim a database on
+        :return: the item_key() of the database, or None if there is nothing left to claim
+        """
+        claim = uuid.uuid4().hex
+        now = time.time()
+        params = [worker, claim, now, self.program, self.program, now - lease]
+        for host in excluded_hosts:
+            prefix = '%s:%s/' % host
+            params.extend([len(prefix), prefix])
+        sql = self.SQL_CLAIM % dict(excluded_hosts=self.SQL_EXCLUDE_HOST * len(excluded_hosts))
+        with self._lock:
+            self.connection.execute(sql, params)
+            self.connection.commit()
+            row = self.connection.execute(self.SQL_SELECT_CLAIM, (self.program, claim)).fetchone()
+        return row[0] if row is not None else None
+
+    def unfinished(self, items):
+        with self._lock:
+            states = dict(self.connection.execute(self.SQL_SELECT_STATES, (self.program,)).fetchall())
+        return [item for item in items if states.get(item_key(item)) != DONE]
+
+    def running(self, item):
+        self._execute(self.SQL_UPDATE_RUNNING, (time.time(), self.program, journal_key(item)))
+
+    def done(self, item, outcome=None):
+        self._execute(self.SQL_UPDATE_FINISHED, (DONE, outcome, time.time(), self.program, journal_key(item)))
+
+    def failed(self, item, outcome):
+        self._execute(self.SQL_UPDATE_FINISHED, (FAILED, outcome, time.time(), self.program, journal_key(item)))
+
+    def _execute(self, sql, params):
+        with self._lock:
+            self.connection.execute(sql, params)
+            self.connection.commit()
@@ -0,0 +1,242 @@
+"""
+Per database timings and counters.
+
+Code that processes a database runs inside metrics.database(key), with the item_key() of the database, as databases
+on different hosts can share a name. Timers and counters used on that thread are then recorded for that database, so
+connections, catalog queries, comparisons and strategies do not need to know which database they work on. Code
+running on another thread, such as a QueuedWriter, passes the key of the database instead.
+"""
+import functools
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from lib.scheduler import Failure, item_key
+from lib.util import write_atomic
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class DatabaseMetrics(object):
+    def __init__(self):
+        self.phases = dict()
+        self.counters = dict()
+
+    def add_time(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_count(self, counter, n):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def merge(self, other):
+        for phase, seconds in other.phases.iteritems():
+            self.add_time(phase, seconds)
+        for counter, n in other.counters.iteritems():
+            self.add_count(counter, n)
+
+    def as_dict(self):
+        return OrderedDict([('phases', OrderedDict(sorted(self.phases.iteritems()))),
+                            ('counters', OrderedDict(sorted(self.counters.iteritems())))])
+
+
+class Metrics(object):
+    """
+    The metrics of every database processed by this process. Worker processes pop() the metrics of the databases
+    they processed and return them, to be merged into the metrics of the main process.
+    """
+
+    def __init__(self):
+        self.databases = dict()
+        self.lock = threading.Lock()
+        self.current = threading.local()
+
+    @contextmanager
+    def database(self, key):
+        """
+        Record the metrics of the calling thread for the database with item_key() key, along with the total time
+        spent in the block. Nested blocks for the same database are part of the outer one.
+        """
+        if self.current_database() == key:
+            yield
+            return
+        self.current.name = key
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time('total', time.time() - start, database=key)
+            self.current.name = None
+
+    @contextmanager
+    def attach(self, key):
+        """
+        Record the metrics of the calling thread for the database with key, as part of a database(key) block that
+        another thread runs, without recording a total of its own.
+        """
+        previous = self.current_database()
+        self.current.name = key
+        try:
+            yield
+        finally:
+            self.current.name = previous
+
+    @contextmanager
+    def timer(self, phase, database=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.time() - start, database=database)
+
+    def timed_iter(self, phase, iterable, counter=None, database=None):
+        """
+        Generate the items of iterable, recording the time spent producing them as phase and their number as counter.
+        """
+        database = database or self.current_database()
+        iterator = iter(iterable)
+        count = 0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.add_time(phase, time.time() - start, database=database)
+                count += 1
+                yield item
+        finally:
+            if counter is not None:
+                self.count(counter, count, database=database)
+
+    def add_time(self, phase, seconds, database=None):
+        with self.lock:
+            metrics = self.get(database)
+            if metrics is not None:
+                metrics.add_time(phase, seconds)
+
+    def count(self, counter, n=1, database=None):
+        with self.lock:
+            metrics = self.get(database)
+            if metrics is not None:
+                metrics.add_count(counter, n)
+
+    def current_database(self):
+        return getattr(self.current, 'name', None)
+
+    def get(self, database=None):
+        # Work done outside of any database, such as loading the reference, is not recorded
+        database = database or self.current_database()
+        if database is None:
+            return None
+        return self.databases.setdefault(database, DatabaseMetrics())
+
+    def pop(self, database):
+        with self.lock:
+            return self.databases.pop(database, None)
+
+    def merge(self, database, database_metrics):
+        if database_metrics is None:
+            return
+        with self.lock:
+            self.databases.setdefault(database, DatabaseMetrics()).merge(database_metrics)
+
+    def merge_results(self, results):
+        """
+        Merge the (database, DatabaseMetrics) tuples returned by functions decorated with metered().
+        """
+        for database, database_metrics in results:
+            self.merge(database, database_metrics)
+
+    def report(self):
+        """
+        :return: a JSON serializable dict of the metrics of every database, and the count, sum, quantiles and
+                 maximum of every phase and counter over all databases
+        """
+        with self.lock:
+            databases = OrderedDict((name, metrics.as_dict()) for name, metrics in sorted(self.databases.iteritems()))
+        fleet = OrderedDict()
+        for kind in ('phases', 'counters'):
+            values = dict()
+            for metrics in databases.itervalues():
+                for name, value in metrics[kind].iteritems():
+                    values.setdefault(name, []).append(value)
+            fleet[kind] = OrderedDict((name, summarize(values[name])) for name in sorted(values))
+        return OrderedDict([('databases', databases), ('fleet', fleet)])
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path, prefix):
+        """
+        Write the fleet metrics in the Prometheus text format, for the node exporter textfile collector.
+        """
+        fleet = self.report()['fleet']
+        lines = list()
+        for kind, unit, help_text in (('phases', 'seconds', 'Time spent per database in a phase'),
+                                      ('counters', 'total', 'Count per database')):
+            metric = '%s_%s_%s' % (prefix, kind[:-1], unit)
+            label = kind[:-1]
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s summary' % metric)
+            for name, summary in fleet[kind].iteritems():
+                for quantile in QUANTILES:
+                    lines.append('%s{%s="%s",quantile="%s"} %r' % (metric, label, name, quantile,
+                                                                   float(summary['p%d' % (quantile * 100)])))
+                lines.append('%s_sum{%s="%s"} %r' % (metric, label, name, float(summary['sum'])))
+                lines.append('%s_count{%s="%s"} %d' % (metric, label, name, summary['count']))
+        write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def metered(func):
+    """
+    Decorator for functions that process a database, given a tuple starting with its ConnectionConfig. The metrics
+    recorded for the database are returned, so worker processes can hand them to the main process. If the function
+    returns a Failure, they are returned in a Failure too.
+    """
+
+    @functools.wraps(func)
+    def _wrapper(arg_tuple):
+        key = item_key(arg_tuple)
+        with metrics.database(key):
+            outcome = func(arg_tuple)
+        result = key, metrics.pop(key)
+        return Failure(result) if isinstance(outcome, Failure) else result
+
+    return _wrapper
+
+
+def summarize(values):
+    values = sorted(values)
+    summary = OrderedDict([('count', len(values)), ('sum', sum(values))])
+    for quantile in QUANTILES:
+        summary['p%d' % (quantile * 100)] = percentile(values, quantile)
+    summary['max'] = values[-1]
+    return summary
+
+
+def percentile(sorted_values, quantile):
+    """
+    Nearest rank percentile of a sorted, non empty list.
+    """
+    rank = int(math.ceil(quantile * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def write_reports(metrics_dir, program):
+    """
+    Write the JSON report and Prometheus textfile of this process to metrics_dir, named after program.
+    """
+    if not os.path.isdir(metrics_dir):
+        os.makedirs(metrics_dir)
+    metrics.write_json(os.path.join(metrics_dir, '%s_metrics.json' % program))
+    metrics.write_prometheus(os.path.join(metrics_dir, '%s.prom' % program), prefix=program)
+
+
+# The metrics of this process
+metrics = Metrics()
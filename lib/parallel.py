@@ -0,0 +1,160 @@
+import multiprocessing
+import sys
+import threading
+import time
+
+from lib.scheduler import DurationHistory, Failure, Scheduler, balance, item_host, item_key
+
+# State of the current worker process, set up by _init_worker()
+_worker = dict()
+
+
+def run_pool(func, items, max_threads, workers=None, initializer=None, initargs=(), max_per_host=None,
+             history_path=None, adaptive=False):
+    """
+    Call func on every item and return the results.
+
+    Items are ConnectionConfigs, or tuples starting with one. They are run by a Scheduler: longest first, as
+    recorded in the history file of earlier runs, and with no more than max_per_host of them on one host at once.
+
+    Without workers, items are processed by max_threads threads of this process. With workers, items are split
+    between that many processes, each of which runs its own scheduler with max_threads threads, so CPU bound work is
+    not serialized on the GIL. The host limit is then split between the processes. func and the items must be
+    picklable in that case.
+
+    :param initializer: called with initargs once in every process that processes items, before the first item. Use
+                        it to load state shared by all items, such as the reference database, instead of passing
+                        that state along with every item.
+    :param history_path: JSON file to read the durations of earlier runs from, and to add those of this run to
+    :param adaptive: adapt the number of items running on a host to how long they take, see Scheduler
+    """
+    history = DurationHistory(history_path)
+    expected = dict((item_key(item), history.get(item_key(item))) for item in items
+                    if history.get(item_key(item)) is not None)
+    if not workers:
+        if initializer is not None:
+            initializer(*initargs)
+        scheduler = Scheduler(max_threads, max_per_host=max_per_host, expected=expected, adaptive=adaptive)
+        try:
+            return scheduler.run(func, items)
+        finally:
+            history.update(scheduler.durations)
+            history.save()
+
+    if max_per_host is not None:
+        max_per_host = max(max_per_host // workers, 1)
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker,
+                                initargs=(max_threads, max_per_host, adaptive, initializer, initargs))
+    partitions = balance(items, expected, workers)
+    chunks = [(func, [items[i] for i in indexes], expected) for indexes in partitions]
+    try:
+        chunk_results = pool.map_async(_run_chunk, chunks, chunksize=1).get(99999)
+    finally:
+        pool.close()
+        pool.join()
+    results = [None] * len(items)
+    for indexes, (partition_results, durations) in zip(partitions, chunk_results):
+        for index, result in zip(indexes, partition_results):
+            results[index] = result
+        history.update(durations)
+    history.save()
+    return results
+
+
+def run_queue(func, items, journal, worker, max_threads, max_per_host=None, lease=3600, history_path=None,
+              resume=False):
+    """
+    Call func on the items this worker claims from the journal, until no unclaimed items are left, and return the
+    results. Any number of workers, started on one host or on several sharing the journal file, can process the same
+    items this way. Each item is processed by one of them, longest first.
+
+    Items missing from the journal are added to it as pending, so the first worker to start fills the queue. Items
+    claimed by a worker more than lease seconds ago without finishing are claimed again, so the items of a worker
+    that died are not lost. Items are only claimed on hosts that have room, so the lease starts when the item does.
+
+    :param worker: name of this worker, recorded in the journal with the items it claims
+    :param max_per_host: maximum number of items this worker runs on a host at once
+    :param resume: process the failed items of a finished run again. Without it, the journal of a finished run
+                   raises a JournalException, see Journal.add()
+    """
+    history = DurationHistory(history_path)
+    by_key = dict((item_key(item), item) for item in items)
+    expected = dict((key, history.get(key)) for key in by_key if history.get(key) is not None)
+    journal.add(items, expected, resume=resume)
+    limit = max_per_host or max_threads
+    running = dict((host, 0) for host in set(item_host(item) for item in items))
+    condition = threading.Condition()
+    results = list()
+    durations = dict()
+    errors = list()
+
+    def take():
+        """
+        Claim an item on a host with room and count it as running there. None when no items are left to claim.
+        """
+        with condition:
+            while True:
+                full = [host for host, count in running.iteritems() if count >= limit]
+                key = journal.claim(worker, lease, excluded_hosts=full)
+                if key is None and not full:
+                    return None
+                if key is not None:
+                    item = by_key.get(key)
+                    if item is None:
+                        # Added by a worker with another configuration, leave it to the workers that know it
+                        journal.failed(key, 'unknown to worker %s' % worker)
+                        continue
+                    running[item_host(item)] += 1
+                    return item
+                # Whatever is left is on full hosts, or claimed by others
+                condition.wait(1)
+
+    def work():
+        while True:
+            item = take()
+            if item is None:
+                return
+            start = time.time()
+            try:
+                result = func(item)
+                if isinstance(result, Failure):
+                    results.append(result.result)
+                else:
+                    results.append(result)
+                    durations[item_key(item)] = time.time() - start
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                with condition:
+                    running[item_host(item)] -= 1
+                    condition.notify_all()
+
+    threads = [threading.Thread(target=work, name='Queue-%d' % i) for i in xrange(min(max_threads, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Joining with a timeout keeps the main thread responsive to KeyboardInterrupt
+        while thread.is_alive():
+            thread.join(1)
+    history.update(durations)
+    history.save()
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+def _init_worker(max_threads, max_per_host, adaptive, initializer, initargs):
+    _worker['max_threads'] = max_threads
+    _worker['max_per_host'] = max_per_host
+    _worker['adaptive'] = adaptive
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_chunk(chunk):
+    func, items, expected = chunk
+    scheduler = Scheduler(_worker['max_threads'], max_per_host=_worker['max_per_host'], expected=expected,
+                          adaptive=_worker['adaptive'])
+    return scheduler.run(func, items), scheduler.durations
@@ -1,7 +1,11 @@
+from lib.diff import iter_tree
+from lib.metrics import metrics
+
+
 class PGCompare(object):
     """
     PGCompare takes a reference database and a test database, compares them and returns the differences
-    represented as a tree of DiffNodes.
+    represented as a tree of DiffNodes, or as a stream of them.
     """
 
     def __init__(self, reference_provider, test_provider):
@@ -9,4 +13,10 @@ class PGCompare(object):
         self.test_db = test_provider.get_database()
 
     def compare(self):
-        return self.reference_db.compare_to(self.test_db)
+        with metrics.timer('compare'):
+            diffs = self.reference_db.compare_to(self.test_db)
+        metrics.count('diffs', sum(1 for _ in iter_tree(diffs)))
+        return diffs
+
+    def iter_diffs(self):
+        return metrics.timed_iter('compare', self.reference_db.iter_diffs(self.test_db), counter='diffs')
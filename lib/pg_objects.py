@@ -1,20 +1,34 @@
+import hashlib
 import sys
+import threading
 from collections import OrderedDict
 
 import psycopg2
 from psycopg2.extras import DictCursor
 
-from lib.diff import DiffNode, DiffItem
+from lib.catalog import IntrospectionScope, SchemaCatalog
+from lib.deadline import deadlines
+from lib.diff import DiffNode, DiffItem, build_tree
+from lib.metrics import metrics
 
 
 class DBConnection(object):
-    def __init__(self, host, database, user, password, port=5432, connect_timeout=30):
+    def __init__(self, host, database, user, password, port=5432, connect_timeout=30, pool=None,
+                 statement_timeout=None, lock_timeout=None):
+        """
+        :param statement_timeout: seconds after which the server cancels an introspection query. No timeout when None
+        :param lock_timeout: seconds after which the server stops waiting for a lock during introspection. No timeout
+                             when None
+        """
         self.host = host
         self.database = database
         self.user = user
         self.password = password
         self.port = port
         self.connect_timeout = connect_timeout
+        self.pool = pool
+        self.statement_timeout = statement_timeout
+        self.lock_timeout = lock_timeout
         self.db_connection = None
 
     def connect(self):
@@ -26,19 +40,195 @@ class DBConnection(object):
                                 connect_timeout=self.connect_timeout)
         return conn
 
+    @property
+    def timeout_settings(self):
+        """
+        The (setting, milliseconds) of the timeouts that are set.
+        """
+        return [(setting, int(seconds * 1000))
+                for setting, seconds in (('statement_timeout', self.statement_timeout),
+                                         ('lock_timeout', self.lock_timeout))
+                if seconds]
+
+    def set_timeouts(self):
+        """
+        Apply statement_timeout and lock_timeout to the following statements on the connection.
+        """
+        if not self.timeout_settings:
+            return
+        cursor = self.connection.cursor()
+        for setting, milliseconds in self.timeout_settings:
+            cursor.execute("SET %s = %d" % (setting, milliseconds))
+        cursor.close()
+
+    def reset_timeouts(self):
+        """
+        Undo set_timeouts(), so statements that change the schema are not cancelled.
+        """
+        if not self.timeout_settings or self.db_connection is None:
+            return
+        try:
+            cursor = self.db_connection.cursor()
+            for setting, _ in self.timeout_settings:
+                cursor.execute("RESET %s" % setting)
+            cursor.close()
+        except psycopg2.Error:
+            # The transaction failed, rolling it back undoes the SET as well
+            pass
+
+    def connect_async(self):
+        """
+        Start an asynchronous connection, with the timeouts set for the whole session as it is only used for
+        introspection. The caller has to poll() it until it is ready.
+        """
+        return psycopg2.connect(database=self.database,
+                                user=self.user,
+                                password=self.password,
+                                host=self.host,
+                                port=self.port,
+                                options=' '.join('-c %s=%d' % setting for setting in self.timeout_settings) or None,
+                                async_=1)
+
     @property
     def connection(self):
+        return self.open()
+
+    def open(self, block=True):
+        """
+        Connect, through the pool if there is one.
+
+        :param block: wait while the host is at the cap of the pool. If False, None is returned instead
+        """
         if self.db_connection is None:
-            self.db_connection = self.connect()
+            with metrics.timer('connect'):
+                if self.pool is not None:
+                    self.db_connection = self.pool.acquire(self, block=block)
+                else:
+                    self.db_connection = self.connect()
+            if self.db_connection is None:
+                return None
+            deadlines.watch(self)
         return self.db_connection
 
+    def copy(self):
+        """
+        A DBConnection to the same database with the same settings, that is not connected yet.
+        """
+        return DBConnection(self.host, self.database, self.user, self.password, port=self.port,
+                            connect_timeout=self.connect_timeout, pool=self.pool,
+                            statement_timeout=self.statement_timeout, lock_timeout=self.lock_timeout)
+
+    def cancel(self):
+        """
+        Cancel the query running on the connection, from any thread.
+        """
+        if self.db_connection is not None:
+            try:
+                self.db_connection.cancel()
+            except psycopg2.Error:
+                pass
+
+    def close(self):
+        """
+        Close the connection, or hand it back to the pool it came from.
+        """
+        if self.db_connection is None:
+            return
+        with deadlines.lock:
+            deadlines.unwatch(self)
+            conn, self.db_connection = self.db_connection, None
+        if self.pool is not None:
+            self.pool.release(self, conn)
+        else:
+            conn.close()
+
+
+def fingerprint_value(value):
+    """
+    Return a repr of value that is stable across runs and database drivers.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, (int, long)) and not isinstance(value, bool):
+        return '%d' % value
+    elif isinstance(value, dict):
+        return repr(sorted((k, fingerprint_value(v)) for k, v in value.iteritems()))
+    return repr(value)
+
+
+def combine_fingerprints(objects, stored=()):
+    """
+    Combine the fingerprints of a list of objects, independent of their order. Returns None if the combination
+    would hide a difference compare_object reports: objects that share a name but not a fingerprint are always
+    compared against the first object of that name.
+
+    :param stored: names of objects whose stored fingerprint is used instead of computing it again
+    """
+    fingerprints = dict()
+    for o in objects:
+        if o.name in stored:
+            fingerprint = getattr(o, 'fingerprint', None)
+        else:
+            fingerprint = o.compute_fingerprint()
+        if fingerprint is None or fingerprints.setdefault(o.name, fingerprint) != fingerprint:
+            return None
+    return sorted(((o.name, o.fingerprint) for o in objects))
+
+
+def compact_value(value):
+    """
+    Share a single copy of strings such as data types, which repeat across thousands of objects.
+    """
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+def slot_names(cls):
+    """
+    Return the names of the slots of cls and its bases.
+    """
+    if '_slot_names' not in cls.__dict__:
+        names = list()
+        for klass in reversed(cls.__mro__):
+            names.extend(name for name in klass.__dict__.get('__slots__', ()) if name not in names)
+        cls._slot_names = tuple(names)
+    return cls._slot_names
+
 
 class DatabaseObject(object):
+    # Subclasses without __slots__ still get a __dict__
+    __slots__ = ()
+
+    # Attributes that are not part of the object content, and so are never compared or fingerprinted
+    meta_attrs = ('fingerprint',)
+
     def construct(self, **kwargs):
         raise NotImplementedError("You must implement construct()!")
 
     def compare_to(self, obj):
-        raise NotImplementedError("You must implement compare_to()!")
+        """
+        :return: the differences with obj as a tree of DiffNodes
+        """
+        return build_tree(self.name, self.iter_diffs(obj))
+
+    def iter_diffs(self, obj):
+        """
+        Generate the differences with obj as they are found, as (path, leaf) tuples. leaf is a DiffNode and path the
+        tuple of our objects that lead to it, eg (table, column) for a column attribute.
+        """
+        raise NotImplementedError("You must implement iter_diffs()!")
+
+    def compute_fingerprint(self):
+        """
+        Compute, store and return a content hash of this object. Objects with equal fingerprints compare without
+        differences. None means the object can not be fingerprinted and must always be compared.
+        """
+        raise NotImplementedError("You must implement compute_fingerprint()!")
+
+    def same_fingerprint(self, other):
+        fingerprint = getattr(self, 'fingerprint', None)
+        return fingerprint is not None and fingerprint == getattr(other, 'fingerprint', None)
 
     def set_attributes(self, query_result, remap_attr_names=None, ignore_none=True):
         for attr_name, attr in query_result.iteritems():
@@ -55,88 +245,122 @@ class DatabaseObject(object):
 
             setattr(self, attr_name, attr)
 
-    def select_as_objects(self, cursor, sql_select, object_type, remap_attr_names, **kwargs):
+    def select_as_objects(self, cursor, sql_select, object_type, **kwargs):
         cursor.execute(sql_select, self.__dict__)
+        return self.rows_as_objects(cursor.fetchall(), object_type, **kwargs)
+
+    def rows_as_objects(self, rows, object_type, **kwargs):
         objects = list()
-        for obj in cursor.fetchall():
+        for obj in rows:
             object_dict = dict(obj)
-            object_dict.update(dict(object_type=object_type, remap_attr_names=remap_attr_names))
             object_dict.update(kwargs)
             objects.append(object_type(**object_dict))
         return objects
 
     def compare_object(self, target_attribute, object_type, other_object):
-        object_diff = DiffNode(name=self.name)
-        for missing_target in self.get_missing(other_object, target_attribute):
-            object_diff.append(
-                DiffNode(name=missing_target.name,
-                         object_type=object_type,
-                         data=DiffItem(name=missing_target.name,
-                                       expected=missing_target,
-                                       found=None)))
-
-        for extra_target in self.get_extra(other_object, target_attribute):
-            object_diff.append(
-                DiffNode(name=extra_target.name,
-                         object_type=object_type,
-                         data=DiffItem(name=extra_target.name,
-                                       expected=None,
-                                       found=extra_target)))
-
-        for matching_target in self.get_matching(other_object, target_attribute):
-            other_target = filter(lambda o: o.name == matching_target.name, getattr(other_object, target_attribute))[0]
-            other_object_diff = matching_target.compare_to(other_target)
-            if other_object_diff.isbranch():
-                object_diff.append(other_object_diff)
-
-        return object_diff
+        return build_tree(self.name, self.iter_object_diffs(target_attribute, object_type, other_object))
+
+    def iter_object_diffs(self, target_attribute, object_type, other_object):
+        missing, extra, matching = self.match_objects(other_object, target_attribute)
+        for missing_target in missing:
+            yield (), DiffNode(name=missing_target.name,
+                               object_type=object_type,
+                               data=DiffItem(name=missing_target.name,
+                                             expected=missing_target,
+                                             found=None))
+
+        for extra_target in extra:
+            yield (), DiffNode(name=extra_target.name,
+                               object_type=object_type,
+                               data=DiffItem(name=extra_target.name,
+                                             expected=None,
+                                             found=extra_target))
+
+        for matching_target, other_target in matching:
+            for path, leaf in matching_target.iter_diffs(other_target):
+                yield (matching_target,) + path, leaf
+
+    def attribute_items(self):
+        """
+        :return: a list of (name, value) for the content attributes set on this object
+        """
+        return [(attr_name, attr) for attr_name, attr in self.__dict__.iteritems()
+                if attr_name not in self.meta_attrs]
 
     def compare_attrs(self, other_obj, ignore_attr=None):
-        attr_diffs = DiffNode(name=self.name)
+        return build_tree(self.name, self.iter_attr_diffs(other_obj, ignore_attr=ignore_attr))
 
-        for attr_name, attr in self.__dict__.iteritems():
+    def iter_attr_diffs(self, other_obj, ignore_attr=None):
+        own_attrs = self.attribute_items()
+        other_attrs = other_obj.attribute_items()
+        own_names = set(attr_name for attr_name, _ in own_attrs)
+        other_values = dict(other_attrs)
+
+        for attr_name, attr in own_attrs:
             if ignore_attr and attr_name == ignore_attr:
                 continue
 
-            if attr_name in other_obj.__dict__:
-                other_attr = other_obj.__dict__[attr_name]
+            if attr_name in other_values:
+                other_attr = other_values[attr_name]
                 if attr != other_attr:
-                    attr_diffs.append(
-                        DiffNode(name=attr_name,
-                                 object_type=ColumnAttribute,
-                                 data=DiffItem(name=attr_name,
-                                               expected=attr,
-                                               found=other_attr)))
+                    yield (), DiffNode(name=attr_name,
+                                       object_type=ColumnAttribute,
+                                       data=DiffItem(name=attr_name,
+                                                     expected=attr,
+                                                     found=other_attr))
             else:
-                attr_diffs.append(
-                    DiffNode(name=attr_name,
-                             object_type=ColumnAttribute,
-                             data=DiffItem(name=attr_name,
-                                           expected=attr,
-                                           found=None)))
-
-        for other_attr_name, other_attr in other_obj.__dict__.iteritems():
+                yield (), DiffNode(name=attr_name,
+                                   object_type=ColumnAttribute,
+                                   data=DiffItem(name=attr_name,
+                                                 expected=attr,
+                                                 found=None))
+
+        for other_attr_name, other_attr in other_attrs:
             if ignore_attr and other_attr_name == ignore_attr:
                 continue
 
-            if other_attr_name not in self.__dict__:
-                attr_diffs.append(
-                    DiffNode(name=other_attr_name,
-                             object_type=ColumnAttribute,
-                             data=DiffItem(name=other_attr_name,
-                                           expected=None,
-                                           found=other_attr)))
+            if other_attr_name not in own_names:
+                yield (), DiffNode(name=other_attr_name,
+                                   object_type=ColumnAttribute,
+                                   data=DiffItem(name=other_attr_name,
+                                                 expected=None,
+                                                 found=other_attr))
+
+    def match_objects(self, obj, target_attr):
+        """
+        Match our target_attr objects against those of obj by name, in a single pass over each list.
+
+        :return: a tuple of (missing, extra, matching), where matching is a list of (ours, theirs) pairs. When a name
+                 occurs more than once, objects are matched against the first one with that name.
+        """
+        own_objects = getattr(self, target_attr)
+        other_objects = getattr(obj, target_attr)
+        own_index = self.index_by_name(own_objects)
+        other_index = self.index_by_name(other_objects)
+
+        missing, matching = list(), list()
+        for o in own_objects:
+            if o.name in other_index:
+                matching.append((o, other_index[o.name]))
+            else:
+                missing.append(o)
+        extra = [o for o in other_objects if o.name not in own_index]
+        return missing, extra, matching
 
-        return attr_diffs
+    def index_by_name(self, objects):
+        index = dict()
+        for o in objects:
+            index.setdefault(o.name, o)
+        return index
 
     def get_missing(self, obj, target_attr):
-        return [o for o in getattr(self, target_attr) if o not in getattr(obj, target_attr)]
+        return self.match_objects(obj, target_attr)[0]
 
     def get_extra(self, obj, target_attr):
-        return [o for o in getattr(obj, target_attr) if o not in getattr(self, target_attr)]
+        return self.match_objects(obj, target_attr)[1]
 
     def get_matching(self, obj, target_attr):
-        return [o for o in getattr(self, target_attr) if o in getattr(obj, target_attr)]
+        return [o for o, _ in self.match_objects(obj, target_attr)[2]]
 
     def __eq__(self, other):
         return self.name == other.name
@@ -157,55 +381,199 @@ class Database(DatabaseObject):
       NOT table_name ILIKE ANY (%(ignore_tables)s)
     """
 
-    SQL_SELECT_PROCEDURES = """
-    SELECT
-      p.proname     AS name,
-      p.pronargs    AS num_args,
-      t1.typname    AS return_type,
-      l.lanname     AS language_type,
-      p.proargtypes AS argument_types_oids,
-      prosrc        AS body
-    FROM pg_proc p
-      LEFT JOIN pg_type t1 ON p.prorettype = t1.oid
-      LEFT JOIN pg_language l ON p.prolang = l.oid
-    WHERE proname IN (
-      SELECT routine_name
-      FROM information_schema.routines
-      WHERE specific_schema NOT IN
-            ('pg_catalog', 'information_schema')
-            AND type_udt_name != 'trigger'
-            AND data_type = 'USER-DEFINED'
-    )
-    """
+    SQL_SELECT_PROCEDURES = SchemaCatalog.SQL_SELECT_PROCEDURES
 
-    def __init__(self, db_connection, ignore_columns=None, ignore_tables=None, schema_name='public'):
+    def __init__(self, db_connection, ignore_columns=None, ignore_tables=None, schema_name='public', bulk=False,
+                 catalog_digests=False, reference=None, catalog=None, connections=1, scope=None):
+        """
+        :param connections: number of connections to fetch the catalog over, each fetching the objects of part of
+                            the tables at the same time. More than one implies bulk
+        :param scope: an IntrospectionScope of the tables and kinds of objects to fetch. Implies bulk
+        """
         self.name = db_connection.database
         self.ignore_columns = ignore_columns if ignore_columns else []
         self.ignore_tables = ignore_tables if ignore_tables else []
         self.schema_name = schema_name
         self.tables = list()
         self.procedures = list()
-        self.construct(cursor=db_connection.connection.cursor(cursor_factory=DictCursor))
+        if catalog is not None:
+            # Already fetched, nothing to select
+            self.construct_from_catalog(catalog)
+        else:
+            cursor = db_connection.connection.cursor(cursor_factory=DictCursor)
+            with metrics.timer('introspect'):
+                self.construct(cursor=cursor, bulk=bulk, catalog_digests=catalog_digests, reference=reference,
+                               db_connection=db_connection, connections=connections, scope=scope)
 
     def construct(self, **kwargs):
+        """
+        Introspect the database. By default every table runs its own queries, with bulk=True each kind of object
+        is fetched for the whole schema in a single query instead. With connections > 1 those queries are split
+        between that many connections to db_connection. With a scope only the tables and kinds of objects in it are
+        fetched.
+
+        With catalog_digests=True the server side digest of every table is stored in catalog_digests. If a
+        reference database is also given, only tables whose digest differs from the reference are fetched.
+        """
         cursor = kwargs['cursor']
-        cursor.execute(self.SQL_CONSTRUCT, self.__dict__)
+        reference = kwargs.get('reference')
+        if kwargs.get('catalog_digests') or reference is not None:
+            self.catalog_digests = SchemaCatalog.select_digests(cursor,
+                                                                schema_name=self.schema_name,
+                                                                ignore_columns=self.ignore_columns,
+                                                                ignore_tables=self.ignore_tables)
+        connections = kwargs.get('connections') or 1
+        scope = kwargs.get('scope') or IntrospectionScope(None, None)
+        if reference is not None:
+            self.construct_from_digests(cursor, reference, kwargs.get('db_connection'), connections, scope)
+            return
+
+        if kwargs.get('bulk') or connections > 1 or kwargs.get('scope') is not None:
+            self.construct_from_catalog(self.fetch_catalog(cursor, kwargs.get('db_connection'), connections,
+                                                           tables=scope.tables, kinds=scope.kinds))
+            return
+
         self.tables.extend([Table(cursor, row['table_name'],
                                   self.name,
                                   ignore_columns=self.ignore_columns)
-                            for row in cursor.fetchall()])
-        self.procedures.extend(self.select_as_objects(cursor,
-                                                      sql_select=self.SQL_SELECT_PROCEDURES,
-                                                      object_type=Procedure,
-                                                      remap_attr_names=dict()))
-
-    def compare_to(self, other_database):
-        db_diffs = DiffNode(name=self.name)
-        table_diffs = self.compare_object('tables', Table, other_database)
-        procedure_diffs = self.compare_object('procedures', Procedure, other_database)
-        db_diffs.merge(procedure_diffs)
-        db_diffs.merge(table_diffs)
-        return db_diffs
+                            for row in SchemaCatalog.select(cursor, 'table_names', self.SQL_CONSTRUCT, self.__dict__)])
+        self.procedures.extend(self.rows_as_objects(SchemaCatalog.select(cursor, 'procedures',
+                                                                         self.SQL_SELECT_PROCEDURES, self.__dict__),
+                                                    object_type=Procedure))
+
+    def construct_from_digests(self, cursor, reference, db_connection=None, connections=1, scope=None):
+        """
+        Fetch the tables whose digest differs from the reference, or that the reference does not have. Tables with
+        a matching digest are shared with the reference database, along with the fingerprint the reference computed.
+        """
+        scope = scope or IntrospectionScope(None, None)
+        reference_digests = getattr(reference, 'catalog_digests', None) or dict()
+        reference_tables = self.index_by_name(reference.tables)
+        in_scope = [table_name for table_name in self.catalog_digests
+                    if scope.tables is None or table_name in scope.tables]
+        unchanged = set(table_name for table_name in in_scope
+                        if table_name in reference_tables
+                        and reference_digests.get(table_name) == self.catalog_digests[table_name])
+
+        catalog = self.fetch_catalog(cursor, db_connection, connections,
+                                     tables=[t for t in in_scope if t not in unchanged], kinds=scope.kinds)
+        self.construct_from_catalog(catalog)
+        self.tables.extend(reference_tables[table_name] for table_name in unchanged)
+        self.tables.sort(key=lambda table: table.name)
+        # Computing their fingerprint again would decode the reference tables that are read lazily from a snapshot
+        self._shared_tables = set(table_name for table_name in unchanged
+                                  if 'fingerprint' in reference_tables[table_name].__dict__)
+
+    def fetch_catalog(self, cursor, db_connection, connections=1, tables=None, kinds=None):
+        """
+        Fetch the catalog of the schema in bulk, or of the given tables and kinds of objects only. Table names are
+        always fetched.
+
+        With more than one connection, the table names and procedures are fetched on cursor first. The tables are
+        then split between cursor and up to connections - 1 further connections to db_connection, which fetch the
+        other kinds of objects for their share at the same time. Further connections are only opened while the
+        connection pool has room for them on the host.
+        """
+        fetch_kwargs = dict(schema_name=self.schema_name, ignore_columns=self.ignore_columns,
+                            ignore_tables=self.ignore_tables)
+        catalog = SchemaCatalog(self.name)
+        kinds = [kind for kind, _ in catalog.bulk_queries if kinds is None or kind in kinds or kind == 'tables']
+        if connections <= 1 or db_connection is None:
+            return catalog.fetch(cursor, tables=tables, kinds=kinds, **fetch_kwargs)
+
+        catalog.fetch(cursor, tables=tables, kinds=[kind for kind in kinds if kind in ('tables', 'procedures')],
+                      **fetch_kwargs)
+        table_names = catalog.table_names
+        further = list()
+        try:
+            for _ in xrange(min(connections, len(table_names)) - 1):
+                db_connection_copy = db_connection.copy()
+                if db_connection_copy.open(block=False) is None:
+                    break
+                further.append(db_connection_copy)
+                # Only used for introspection. Handing it back to the pool rolls back, which undoes the SET
+                db_connection_copy.set_timeouts()
+            cursors = [cursor] + [c.connection.cursor(cursor_factory=DictCursor) for c in further]
+            partitions = [table_names[i::len(cursors)] for i in xrange(len(cursors))]
+            partition_kinds = [kind for kind in kinds if kind not in ('tables', 'procedures')]
+            for partition in self.fetch_partitions(cursors, partitions, partition_kinds, fetch_kwargs):
+                catalog.merge(partition)
+        finally:
+            for db_connection_copy in further:
+                db_connection_copy.close()
+        metrics.count('introspection_connections', len(cursors))
+        return catalog
+
+    def fetch_partitions(self, cursors, partitions, kinds, fetch_kwargs):
+        """
+        Fetch the catalog of every partition of tables on its own cursor, the first on the calling thread and the
+        others on threads of their own.
+
+        :return: a SchemaCatalog per partition. If any fetch failed, its exception is raised once all are done
+        """
+        catalogs = [None] * len(cursors)
+        errors = list()
+        database_key = metrics.current_database()
+
+        def fetch(index):
+            try:
+                with metrics.attach(database_key):
+                    catalogs[index] = SchemaCatalog(self.name).fetch(cursors[index], tables=partitions[index],
+                                                                     kinds=kinds, **fetch_kwargs)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=fetch, args=(index,), name='Introspect-%d' % index)
+                   for index in xrange(1, len(cursors))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        fetch(0)
+        for thread in threads:
+            thread.join()
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+        return catalogs
+
+    def construct_from_catalog(self, catalog):
+        self.tables.extend([Table(None, table_name,
+                                  self.name,
+                                  ignore_columns=self.ignore_columns,
+                                  catalog=catalog)
+                            for table_name in catalog.table_names])
+        self.procedures.extend(self.rows_as_objects(catalog.get('procedures'), object_type=Procedure))
+
+    def scoped(self, scope):
+        """
+        A copy of this database with only the tables and kinds of objects in scope, as introspecting it with that
+        scope gives. Tables that are left out are not loaded from a snapshot.
+        """
+        database = Database.__new__(Database)
+        database.__dict__.update(self.__dict__)
+        database.tables = [table.scoped(scope.kinds) for table in self.tables
+                           if scope.tables is None or table.name in scope.tables]
+        if scope.kinds is not None and 'procedures' not in scope.kinds:
+            database.procedures = list()
+        database.compute_fingerprint()
+        return database
+
+    def compute_fingerprint(self):
+        tables = combine_fingerprints(self.tables, stored=self.__dict__.get('_shared_tables', ()))
+        procedures = combine_fingerprints(self.procedures)
+        if tables is None or procedures is None:
+            self.fingerprint = None
+        else:
+            self.fingerprint = hashlib.md5(repr((tables, procedures))).hexdigest()
+        return self.fingerprint
+
+    def iter_diffs(self, other_database):
+        if self.same_fingerprint(other_database):
+            return
+        for diff in self.iter_object_diffs('procedures', Procedure, other_database):
+            yield diff
+        for diff in self.iter_object_diffs('tables', Table, other_database):
+            yield diff
 
 
 class Table(DatabaseObject):
@@ -335,7 +703,16 @@ class Table(DatabaseObject):
 		NOT a.attname ILIKE ANY (%(ignore_columns)s)
     """
 
-    def __init__(self, cursor, table_name, database_name, ignore_columns=None):
+    # Lists of BaseTableAttributes making up a table
+    attribute_lists = ('check_constraints', 'columns', 'foreign_keys', 'indexes', 'primary_keys', 'triggers',
+                       'unique_constraints')
+
+    # The kind of SchemaCatalog rows every list is built from
+    attribute_kinds = dict(check_constraints='constraints', columns='columns', foreign_keys='foreign_keys',
+                           indexes='indexes', primary_keys='constraints', triggers='triggers',
+                           unique_constraints='constraints')
+
+    def __init__(self, cursor, table_name, database_name, ignore_columns=None, catalog=None):
         self.name = table_name
         self.database_name = database_name
         self.ignore_columns = ignore_columns if ignore_columns else []
@@ -347,45 +724,81 @@ class Table(DatabaseObject):
         self.unique_constraints = list()
         self.indexes = list()
 
-        self.construct(cursor=cursor)
+        self.construct(cursor=cursor, catalog=catalog)
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set. Tables read from a snapshot are decoded at this point.
+        if '_loader' not in self.__dict__ or name.startswith('__'):
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+    def __getstate__(self):
+        self.load()
+        return self.__dict__
+
+    def load(self):
+        """
+        Decode the table now if it was read lazily from a snapshot.
+        """
+        if '_loader' in self.__dict__:
+            self.__dict__['_loader'].load(self)
 
     def construct(self, **kwargs):
-        cursor = kwargs['cursor']
-        cursor.execute(self.SQL_CONSTRUCT, self.__dict__)
-        self.set_attributes(cursor.fetchone())
-        self.set_constraints(cursor)
-        self.columns.extend(self.select_as_objects(cursor,
-                                                   sql_select=self.SQL_SELECT_COLUMNS,
-                                                   object_type=Column,
-                                                   remap_attr_names=dict(column_name='name')))
-        self.triggers.extend(self.select_as_objects(cursor,
-                                                    sql_select=self.SQL_SELECT_TRIGGERS,
-                                                    object_type=Trigger,
-                                                    remap_attr_names=dict(trigger_name='name')))
-        self.indexes.extend(self.select_as_objects(cursor,
-                                                   sql_select=self.SQL_SELECT_INDEXES,
-                                                   object_type=Index,
-                                                   remap_attr_names=dict(
-                                                       column_name='name')))  ## Indexes are compared based on the column they target as the names often differ
-        self.foreign_keys.extend(self.select_as_objects(cursor,
-                                                        sql_select=self.SQL_SELECT_FOREIGN_KEYS,
-                                                        object_type=ForeignKey,
-                                                        remap_attr_names=dict(constraint_name='name')))
-
-    def set_constraints(self, cursor):
-        cursor.execute(self.SQL_SELECT_CONSTRAINTS, self.__dict__)
-        for const in cursor.fetchall():
+        """
+        Build the table from the rows of a SchemaCatalog. If no catalog is given, the rows for this table are
+        selected with the cursor.
+        """
+        catalog = kwargs.get('catalog')
+        if catalog is None:
+            catalog = self.select_catalog(kwargs['cursor'])
+
+        self.set_attributes(catalog.get('tables', self.name)[0])
+        self.set_constraints(catalog.get('constraints', self.name))
+        self.columns.extend(self.rows_as_objects(catalog.get('columns', self.name), object_type=Column))
+        self.triggers.extend(self.rows_as_objects(catalog.get('triggers', self.name), object_type=Trigger))
+        self.indexes.extend(self.rows_as_objects(catalog.get('indexes', self.name), object_type=Index))
+        self.foreign_keys.extend(self.rows_as_objects(catalog.get('foreign_keys', self.name),
+                                                      object_type=ForeignKey))
+
+    def scoped(self, kinds):
+        """
+        A copy of this table with only the objects of the given kinds, sharing them. The table itself if kinds is
+        None.
+        """
+        if kinds is None:
+            return self
+        table = Table.__new__(Table)
+        table.__dict__.update(self.__getstate__())
+        for name in self.attribute_lists:
+            if self.attribute_kinds[name] not in kinds:
+                table.__dict__[name] = list()
+        table.compute_fingerprint()
+        return table
+
+    def select_catalog(self, cursor):
+        """
+        Select the catalog rows of this table only.
+        """
+        catalog = SchemaCatalog(self.database_name)
+        for kind, sql_select in (('tables', self.SQL_CONSTRUCT),
+                                 ('constraints', self.SQL_SELECT_CONSTRAINTS),
+                                 ('columns', self.SQL_SELECT_COLUMNS),
+                                 ('triggers', self.SQL_SELECT_TRIGGERS),
+                                 ('indexes', self.SQL_SELECT_INDEXES),
+                                 ('foreign_keys', self.SQL_SELECT_FOREIGN_KEYS)):
+            catalog.add_rows(kind, SchemaCatalog.select(cursor, kind, sql_select, self.__dict__), table_name=self.name)
+        return catalog
+
+    def set_constraints(self, constraints):
+        for const in constraints:
             constraint = dict(const)
             constraint_type = constraint['constraint_type']
-            constraint.update(dict(remap_attr_names=dict(constraint_name='name')))
             if constraint_type == 'CHECK':
-                constraint.update(dict(object_type=CheckConstraint))
                 self.check_constraints.append(CheckConstraint(**constraint))
             elif constraint_type == 'PRIMARY KEY':
-                constraint.update(dict(object_type=PrimaryKey))
                 self.primary_keys.append(PrimaryKey(**constraint))
             elif constraint_type == 'UNIQUE':
-                constraint.update(dict(object_type=UniqueConstraint))
                 self.unique_constraints.append(UniqueConstraint(**constraint))
             elif constraint_type == 'FOREIGN KEY':
                 # We select more information about foreign keys in a separate query.
@@ -393,7 +806,21 @@ class Table(DatabaseObject):
             else:
                 sys.stderr.write("Unknown Constraint: %s\n" % constraint_type)
 
-    def compare_to(self, other_table):
+    def compute_fingerprint(self):
+        if '_loader' in self.__dict__ and 'fingerprint' in self.__dict__:
+            # Not decoded from its snapshot yet, so still the content the stored fingerprint is of
+            return self.fingerprint
+        attributes = list()
+        for name in self.attribute_lists:
+            fingerprints = combine_fingerprints(getattr(self, name))
+            if fingerprints is None:
+                self.fingerprint = None
+                return self.fingerprint
+            attributes.append((name, fingerprints))
+        self.fingerprint = hashlib.md5(repr(attributes)).hexdigest()
+        return self.fingerprint
+
+    def iter_diffs(self, other_table):
         db_objects = OrderedDict(columns=Column,
                                  check_constraints=CheckConstraint,
                                  primary_keys=PrimaryKey,
@@ -401,62 +828,136 @@ class Table(DatabaseObject):
                                  unique_constraints=UniqueConstraint,
                                  triggers=Trigger,
                                  indexes=Index)
-        table_diffs = DiffNode(self.name)
+        if self.same_fingerprint(other_table):
+            return
+        # Comparing runs no queries the deadline watchdog could cancel, and may load the table from a snapshot
+        deadlines.check()
         for name, object_type in db_objects.iteritems():
-            table_diffs.merge(self.compare_object(name, object_type, other_table))
-        return table_diffs
+            for diff in self.iter_object_diffs(name, object_type, other_table):
+                yield diff
 
 
 class BaseTableAttribute(DatabaseObject):
+    """
+    An object of a table, or a procedure. There can be many thousands of these in a database, so they keep their
+    attributes in slots rather than a __dict__: every subclass lists the attributes its catalog query selects in
+    __slots__, and its catalog column to attribute name mapping in remap_attr_names. String values are interned.
+    """
+    __slots__ = ('name', 'ignore_attr', 'fingerprint')
+
+    meta_attrs = ('fingerprint', 'ignore_attr')
+    remap_attr_names = dict()
+
     def __init__(self, **kwargs):
-        self.object_type = kwargs['object_type']
-        self.remap_attr_names = kwargs['remap_attr_names']
         self.ignore_attr = kwargs.pop('ignore_attr', None)
         self.construct(**kwargs)
 
+    @property
+    def object_type(self):
+        return self.__class__
+
     def construct(self, **kwargs):
-        self.set_attributes(kwargs, remap_attr_names=self.remap_attr_names)
+        self.set_attributes(dict((attr_name, compact_value(attr)) for attr_name, attr in kwargs.iteritems()),
+                            remap_attr_names=self.remap_attr_names)
 
-    def compare_to(self, other_column):
-        return self.compare_attrs(other_column, ignore_attr=self.ignore_attr)
+    def attribute_items(self):
+        items = list()
+        for attr_name in slot_names(self.__class__):
+            if attr_name not in self.meta_attrs and hasattr(self, attr_name):
+                items.append((attr_name, getattr(self, attr_name)))
+        return items
+
+    def compute_fingerprint(self):
+        content = sorted((attr_name, fingerprint_value(attr)) for attr_name, attr in self.attribute_items()
+                         if attr_name != self.ignore_attr)
+        self.fingerprint = hashlib.md5(repr(content)).hexdigest()
+        return self.fingerprint
+
+    def iter_diffs(self, other_column):
+        if self.same_fingerprint(other_column):
+            return iter(())
+        return self.iter_attr_diffs(other_column, ignore_attr=self.ignore_attr)
+
+    def __getstate__(self):
+        return dict((attr_name, getattr(self, attr_name)) for attr_name in slot_names(self.__class__)
+                    if hasattr(self, attr_name))
+
+    def __setstate__(self, state):
+        if 'ignore_attr' not in state:
+            self.ignore_attr = None
+        for attr_name, attr in state.iteritems():
+            # Older pickles store the type and name mapping on every object
+            if attr_name not in ('object_type', 'remap_attr_names'):
+                setattr(self, attr_name, compact_value(attr))
+
+
+CONSTRAINT_FIELDS = ('constraint_type', 'is_deferrable', 'is_deferred', 'table_name', 'on_update', 'on_delete',
+                     'match_type', 'references_table', 'fk_constraint_key')
 
 
 class Column(BaseTableAttribute):
+    __slots__ = ('data_type', 'udt_name', 'column_default', 'is_nullable', 'character_maximum_length',
+                 'numeric_precision')
+    remap_attr_names = dict(column_name='name')
+
     def __init__(self, **kwargs):
         BaseTableAttribute.__init__(self, **kwargs)
 
 
 class CheckConstraint(BaseTableAttribute):
+    __slots__ = CONSTRAINT_FIELDS
+    remap_attr_names = dict(constraint_name='name')
+
     def __init__(self, **kwargs):
         BaseTableAttribute.__init__(self, **kwargs)
 
 
 class ForeignKey(BaseTableAttribute):
+    __slots__ = ('table_schema', 'table_name', 'column_name', 'foreign_table_name', 'foreign_column_name')
+    remap_attr_names = dict(constraint_name='name')
+
     def __init__(self, **kwargs):
         BaseTableAttribute.__init__(self, **kwargs)
 
 
 class PrimaryKey(BaseTableAttribute):
+    __slots__ = CONSTRAINT_FIELDS
+    remap_attr_names = dict(constraint_name='name')
+
     def __init__(self, **kwargs):
         BaseTableAttribute.__init__(self, **kwargs)
 
 
 class UniqueConstraint(BaseTableAttribute):
+    __slots__ = CONSTRAINT_FIELDS
+    remap_attr_names = dict(constraint_name='name')
+
     def __init__(self, **kwargs):
         BaseTableAttribute.__init__(self, **kwargs)
 
 
 class Trigger(BaseTableAttribute):
+    __slots__ = ('event_object_table', 'action_order', 'action_condition', 'action_statement', 'action_orientation',
+                 'action_timing', 'action_reference_old_table', 'action_reference_new_table',
+                 'action_reference_new_row', 'created')
+    remap_attr_names = dict(trigger_name='name')
+
     def __init__(self, **kwargs):
         BaseTableAttribute.__init__(self, **kwargs)
 
 
 class Index(BaseTableAttribute):
+    __slots__ = ('table_name',)
+    # Indexes are compared based on the column they target as the names often differ
+    remap_attr_names = dict(column_name='name')
+
     def __init__(self, **kwargs):
         BaseTableAttribute.__init__(self, **kwargs)
 
 
 class Procedure(BaseTableAttribute):
+    __slots__ = ('num_args', 'return_type', 'language_type', 'argument_types_oids', 'body')
+
     def __init__(self, **kwargs):
         BaseTableAttribute.__init__(self, **kwargs)
 
@@ -467,3 +968,13 @@ class ColumnAttribute(DatabaseObject):
 
     def compare_to(self, obj):
         raise NotImplemented()
+
+
+# The types of the objects built from every kind of SchemaCatalog rows
+CATALOG_KIND_TYPES = OrderedDict([('tables', (Table,)),
+                                  ('constraints', (CheckConstraint, PrimaryKey, UniqueConstraint)),
+                                  ('columns', (Column,)),
+                                  ('triggers', (Trigger,)),
+                                  ('indexes', (Index,)),
+                                  ('foreign_keys', (ForeignKey,)),
+                                  ('procedures', (Procedure,))])
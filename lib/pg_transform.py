@@ -1,35 +1,91 @@
 #!/usr/bin/env python
-from lib.strategy import Strategy, AttributeStrategy, TypeStrategy
+from lib.catalog import IntrospectionScope
+from lib.deadline import deadlines
+from lib.diff import DiffIndex
+from lib.metrics import metrics
+from lib.plan import RecordingCursor, diff_signature
+from lib.strategy import Strategy, AttributeStrategy, TypeStrategy, alter_table_statements
 from lib.util import get_subclasses, print_info, print_warn
 
+# Strategy classes, found once per process
+_strategy_classes = list()
+
 
 class PGTransform(object):
     """
     Transform the target database by executing the relevant strategies on it.
     """
 
-    def __init__(self, test_dbconnection_provider, database_diffs, config, target_name):
+    def __init__(self, test_dbconnection_provider, database_diffs, config, target_name, strategies=None,
+                 plan_cache=None):
+        """
+        :param strategies: the enabled strategies, as returned by load_strategies(config). Loaded if not given.
+        :param plan_cache: a PlanCache to take the statements to execute from, if the diffs have been planned before
+        """
         self.db_connection = test_dbconnection_provider.db_connection.connection
+        self.cursor = None
+        self.alter_actions = list()
         self.database_diffs = database_diffs
-        self.strategies = get_subclasses(package='strategies', BaseClass=Strategy)
+        self.diff_index = DiffIndex(database_diffs)
+        self.strategies = strategies if strategies is not None else self.load_strategies(config)
         self.config = config
         self.target_attr_name = target_name
+        self.plan_cache = plan_cache
+
+    @staticmethod
+    def load_strategies(config):
+        """
+        Return an instance of every strategy enabled in config.
+        """
+        if not _strategy_classes:
+            _strategy_classes.extend(get_subclasses(package='strategies', BaseClass=Strategy))
+        strategies = list()
+        for strategy_class in _strategy_classes:
+            strategy_config = config.get_strategy(strategy_class.__name__)
+            if strategy_config is not None:
+                strategies.append(strategy_class(**strategy_config))
+        return strategies
+
+    @staticmethod
+    def introspection_scope(strategies):
+        """
+        Return the IntrospectionScope of the tables and kinds of objects the strategies can act on: the tables in
+        their applicable_tables, or all tables if any of them has none, and the kinds of objects they target.
+        Introspecting the reference and the target with this scope finds every difference the strategies act on.
+        """
+        tables = set()
+        kinds = set()
+        for strategy in strategies:
+            if tables is not None:
+                tables = tables.union(strategy.applicable_tables) if strategy.applicable_tables else None
+            if kinds is not None:
+                kinds = kinds.union(strategy.kinds) if strategy.kinds is not None else None
+        return IntrospectionScope(sorted(tables) if tables is not None else None,
+                                  sorted(kinds) if kinds is not None else None)
 
     def transform(self, commit=False):
         """
-        For each strategy, loop over it's applicable nodes and call the strategy.execute() method on it.
+        For each strategy, loop over it's applicable nodes and call the strategy.execute() method on it. With a plan
+        cache, the statements are taken from the plan for the signature of the diffs instead. Nothing is committed
+        once the deadline of the database expired.
 
         :param commit: whether or not to commit
         """
 
+        deadlines.check()
         print_info("Transforming: ", self.target_attr_name)
-        for strategy_class in self.strategies:
-            strategy_config = self.config.get_strategy(strategy_class.__name__)
-            if strategy_config is not None:
-                strategy = strategy_class(**strategy_config)
-                print_info('Applying strategy: ', strategy_class.__name__)
-                for diff_node in self.get_target_nodes(strategy):
-                    self.apply_strategy(diff_node, strategy)
+        self.cursor = self.db_connection.cursor()
+        plan = None
+        if self.plan_cache is not None:
+            plan = self.plan_cache.get_plan(diff_signature(self.database_diffs), self.build_plan)
+        if plan is not None:
+            print_info("Executing plan: ", "%s, %d statements" % (plan.signature, len(plan.statements)))
+            with metrics.timer('plan'):
+                plan.execute(self.cursor)
+        else:
+            self.apply_strategies()
+        self.cursor.close()
+        deadlines.check()
         if commit:
             self.db_connection.commit()
             print_info("Changes committed!")
@@ -37,6 +93,51 @@ class PGTransform(object):
             print_warn("Dry run", " - nothing committed")
             self.db_connection.rollback()
 
+    def apply_strategies(self):
+        """
+        Apply every strategy to its nodes. The ALTER TABLE actions of all strategies are collected first and executed
+        as one statement per table, whatever order the strategies come in. The strategies that do not return actions,
+        such as dropping tables, are executed after that.
+        """
+        executed = list()
+        for strategy in self.strategies:
+            print_info('Applying strategy: ', strategy.name)
+            for diff_node in self.get_target_nodes(strategy):
+                if not self.collect_alter_actions(diff_node, strategy):
+                    executed.append((diff_node, strategy))
+        self.flush_alter_actions()
+        for diff_node, strategy in executed:
+            self.apply_strategy(diff_node, strategy)
+
+    def build_plan(self):
+        """
+        Apply the strategies to a RecordingCursor.
+
+        :return: the (sql, params) statements they executed
+        """
+        cursor, self.cursor = self.cursor, RecordingCursor()
+        try:
+            self.apply_strategies()
+            return self.cursor.statements
+        finally:
+            self.cursor = cursor
+            self.alter_actions = list()
+
+    def collect_alter_actions(self, node, strategy):
+        """
+        Hold back the ALTER TABLE actions of a strategy for node, to be combined with the actions of other strategies
+        on the same table.
+
+        :return: False if the strategy does not return actions, and has to be applied with apply_strategy() instead
+        """
+        with metrics.timer('strategy.%s' % strategy.name):
+            actions = strategy.alter_actions(node)
+        if actions is None:
+            return False
+        self.alter_actions.extend(actions)
+        metrics.count('strategy_nodes')
+        return True
+
     def apply_strategy(self, node, strategy):
         """
         Apply a strategy.
@@ -45,9 +146,18 @@ class PGTransform(object):
         :param strategy: the strategy to call execute() on
         :return:
         """
-        cursor = self.db_connection.cursor()
-        strategy.execute(cursor, node)
-        cursor.close()
+        with metrics.timer('strategy.%s' % strategy.name):
+            strategy.execute(self.cursor, node)
+        metrics.count('strategy_nodes')
+
+    def flush_alter_actions(self):
+        """
+        Execute the held back ALTER TABLE actions, one statement per table.
+        """
+        with metrics.timer('alter_table'):
+            for statement in alter_table_statements(self.alter_actions):
+                self.cursor.execute(statement)
+        self.alter_actions = list()
 
     def get_target_nodes(self, strategy):
         """
@@ -68,47 +178,19 @@ class PGTransform(object):
         """
         Return all matching nodes for this strategy. A node is considered to match if it's target attribute
         is equal to the target parameter that is passed in (essentially getattr(somenode, attribute) == target)).
+        If applicable_tables or applicable_columns are set, the node must also belong to one of those tables and or
+        columns.
 
         :param strategy: the target to gather nodes for
         :param target: target to compare with. Can be a subclass of DatabaseObject or a ColumnAttribute name
         :param attribute: the name of the DiffNode attribute to compare with target.
         :return:
         """
-        if strategy.applicable_tables:
-            return self.get_targets_from_tables(strategy, target=target, attribute=attribute)
-        elif strategy.applicable_columns:
-            return self.get_targets_from_columns(strategy, target=target, attribute=attribute)
-        else:
-            return self.database_diffs.findall(target, attribute)
-
-    def get_targets_from_tables(self, strategy, target, attribute):
-        """
-        Only return nodes that belong to the tables specified in applicable_tables
-        """
         nodes = list()
-        for table in strategy.applicable_tables:
-            t = self.database_diffs.find(table)
-            if t:
-                if strategy.applicable_columns:
-                    nodes.extend(
-                        self.get_targets_from_columns(strategy, target=target, attribute=attribute, table_node=t))
-                else:
-                    nodes.extend(t.findall(target, attribute=attribute))
+        for table in self.unique(strategy.applicable_tables) or [None]:
+            for column in self.unique(strategy.applicable_columns) or [None]:
+                nodes.extend(self.diff_index.find(target, attribute=attribute, table=table, column=column))
         return nodes
 
-    def get_targets_from_columns(self, strategy, target, attribute, table_node=None):
-        """
-        Only return nodes that belong to the columns specified in applicable_columns
-        """
-        nodes = list()
-        for column_name in strategy.applicable_columns:
-            if table_node is not None:
-                c = table_node.find(column_name)
-                if c:
-                    nodes.extend(c.findall(target, attribute=attribute))
-            else:
-                for diff_node in self.database_diffs.findall(target, attribute=attribute):
-                    # parent.name is column_name
-                    if diff_node.parent.name in strategy.applicable_columns:
-                        nodes.append(diff_node)
-        return nodes
+    def unique(self, names):
+        return [name for i, name in enumerate(names) if name not in names[:i]]
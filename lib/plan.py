@@ -0,0 +1,102 @@
+import hashlib
+import os
+import threading
+
+from lib.diff import iter_tree
+from lib.exception import PlanException
+from lib.pg_objects import DatabaseObject
+
+
+def diff_signature(database_diffs):
+    """
+    Return a digest of everything strategies see of a difference tree: the path, name and type of every leaf and
+    the values it expected and found. Databases that drifted the same way have the same signature.
+    """
+    digest = hashlib.md5()
+    for path, leaf in iter_tree(database_diffs):
+        object_type = leaf.object_type.__name__ if leaf.object_type is not None else None
+        digest.update(repr((tuple(node.name for node in path), leaf.name, object_type,
+                            signature_value(leaf.data.expected), signature_value(leaf.data.found))))
+        digest.update('\n')
+    return digest.hexdigest()
+
+
+def signature_value(value):
+    if isinstance(value, DatabaseObject):
+        # The repr of an object is only its name
+        return value.__class__.__name__, value.name, getattr(value, 'fingerprint', None)
+    return repr(value)
+
+
+class RecordingCursor(object):
+    """
+    Stands in for a cursor while a plan is built: statements are recorded instead of executed. Strategies that read
+    from the database can not be planned.
+    """
+
+    def __init__(self):
+        self.statements = list()
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        raise PlanException("cursor.%s can not be used while planning" % name)
+
+
+class TransformPlan(object):
+    """
+    The statements the strategies execute for a given diff signature, in order.
+    """
+
+    def __init__(self, signature, statements):
+        self.signature = signature
+        self.statements = statements
+
+    def execute(self, cursor):
+        for sql, params in self.statements:
+            cursor.execute(sql, params)
+
+    def to_sql(self):
+        lines = ["-- Plan %s" % self.signature]
+        for sql, params in self.statements:
+            if params:
+                lines.append("-- Parameters: %r" % (params,))
+            lines.append(sql.strip() + ';')
+        return "\n".join(lines) + "\n"
+
+
+class PlanCache(object):
+    """
+    Plans by diff signature, each built once and shared by all databases with that signature.
+    """
+
+    def __init__(self, plan_dir=None):
+        """
+        :param plan_dir: directory to write every plan to as <signature>.sql, for review
+        """
+        self.plan_dir = plan_dir
+        self.plans = dict()
+        self.lock = threading.Lock()
+        if plan_dir and not os.path.isdir(plan_dir):
+            os.makedirs(plan_dir)
+
+    def get_plan(self, signature, build):
+        """
+        Return the plan for signature, calling build() to get its statements the first time. Returns None if the
+        strategies can not be planned, as build() raised a PlanException.
+        """
+        with self.lock:
+            if signature not in self.plans:
+                try:
+                    plan = TransformPlan(signature, build())
+                except PlanException:
+                    plan = None
+                if plan is not None and self.plan_dir:
+                    with open(os.path.join(self.plan_dir, signature + '.sql'), 'w') as plan_file:
+                        plan_file.write(plan.to_sql())
+                self.plans[signature] = plan
+            return self.plans[signature]
@@ -1,5 +1,8 @@
+from lib.catalog_export import read_catalog_export
+from lib.deadline import deadlines
 from lib.pg_objects import DBConnection
 from lib.pg_objects import Database
+from lib.snapshot import Snapshot, is_snapshot
 from util import unpickle_database
 
 
@@ -7,13 +10,54 @@ class DBProvider(object):
     def get_database(self):
         raise NotImplementedError("You must implement get_database()!")
 
+    def close(self):
+        """
+        Release any connection held by this provider.
+        """
+
 
 class PickleProvider(DBProvider):
     """
-    Deserialize a pickled database
+    Deserialize a pickled database, or read it from a snapshot
+    """
+    def __init__(self, pickle_path, scope=None):
+        """
+        :param scope: an IntrospectionScope to restrict the database to, as if it was introspected with it
+        """
+        self.snapshot = None
+        if is_snapshot(pickle_path):
+            self.snapshot = Snapshot(pickle_path)
+            self.database = self.snapshot.get_database()
+        else:
+            self.database = unpickle_database(pickle_path)
+        if not hasattr(self.database, 'fingerprint'):
+            # Pickled before fingerprints were stored
+            self.database.compute_fingerprint()
+        if scope is not None:
+            self.database = self.database.scoped(scope)
+
+    def get_database(self):
+        return self.database
+
+    def close(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+
+
+class CatalogExportProvider(DBProvider):
+    """
+    Build a Database object from a catalog export, without connecting. The result is the same as introspecting the
+    database in bulk at the time it was exported.
     """
-    def __init__(self, pickle_path):
-        self.database = unpickle_database(pickle_path)
+    def __init__(self, export_path):
+        header, catalog = read_catalog_export(export_path)
+        self.db_connection = DBConnection(host=None, database=header['database'], user=None, password=None)
+        self.database = Database(self.db_connection,
+                                 ignore_columns=header['ignore_columns'],
+                                 ignore_tables=header['ignore_tables'],
+                                 schema_name=header['schema_name'],
+                                 catalog=catalog)
+        self.database.compute_fingerprint()
 
     def get_database(self):
         return self.database
@@ -24,14 +68,51 @@ class DBConnectionProvider(DBProvider):
     Build a Database object from a live connection.
     """
     def __init__(self, host, database, user, password, port=5432, ignore_columns=None,
-                 ignore_tables=None):
+                 ignore_tables=None, bulk=False, catalog_digests=False, reference=None, pool=None, cache=None,
+                 statement_timeout=None, lock_timeout=None, connections=1, scope=None):
+        """
+        :param cache: a CatalogCache to take the database from if its schema did not change since it was cached
+        :param connections: number of connections to split the introspection of the database between
+        :param scope: an IntrospectionScope of the tables and kinds of objects to introspect. Not cached
+        :param statement_timeout: seconds after which the server cancels an introspection query
+        :param lock_timeout: seconds after which the server stops waiting for a lock
+        """
+        self.snapshot = None
         self.db_connection = DBConnection(host=host,
                                           database=database,
                                           user=user,
                                           password=password,
-                                          port=port)
-        self.database = Database(self.db_connection, ignore_columns=ignore_columns,
-                                 ignore_tables=ignore_tables)
+                                          port=port,
+                                          pool=pool,
+                                          statement_timeout=statement_timeout,
+                                          lock_timeout=lock_timeout)
+
+        def build():
+            built = Database(self.db_connection, ignore_columns=ignore_columns, ignore_tables=ignore_tables,
+                             bulk=bulk, catalog_digests=catalog_digests, reference=reference,
+                             connections=connections, scope=scope)
+            built.compute_fingerprint()
+            return built
+
+        try:
+            # The timeouts only apply to introspection, not to the changes made on the connection afterwards
+            self.db_connection.set_timeouts()
+            if cache is not None and scope is None:
+                self.database, self.snapshot = cache.get_database(self.db_connection, build,
+                                                                  ignore_columns=ignore_columns,
+                                                                  ignore_tables=ignore_tables)
+            else:
+                self.database = build()
+            self.db_connection.reset_timeouts()
+            deadlines.check()
+        except Exception:
+            self.close()
+            raise
 
     def get_database(self):
         return self.database
+
+    def close(self):
+        self.db_connection.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
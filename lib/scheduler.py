@@ -0,0 +1,221 @@
+import json
+import os
+import sys
+import threading
+import time
+
+from lib.util import write_atomic
+
+
+class Failure(object):
+    """
+    Returned instead of raising by a function that processes a database, when it reported the failure of the
+    database itself so the other databases are not affected. The Scheduler then counts the database as failed for the
+    limit of its host, and does not record its duration. The result for the database is result.
+    """
+
+    def __init__(self, result=None):
+        self.result = result
+
+
+def item_config(item):
+    """
+    The ConnectionConfig of an item: the item itself, or the first element of an argument tuple.
+    """
+    return item if hasattr(item, 'host') else item[0]
+
+
+def item_host(item):
+    config = item_config(item)
+    return config.host, config.port
+
+
+def item_key(item):
+    config = item_config(item)
+    return '%s:%s/%s' % (config.host, config.port, config.database)
+
+
+class DurationHistory(object):
+    """
+    How long every database took to process in earlier runs, as a moving average, stored as JSON.
+    """
+
+    def __init__(self, path=None, weight=0.5):
+        """
+        :param weight: weight of the latest run in the average
+        """
+        self.path = path
+        self.weight = weight
+        self.durations = dict()
+        if path and os.path.exists(path):
+            with open(path) as history_file:
+                self.durations = json.load(history_file)
+
+    def get(self, key):
+        return self.durations.get(key)
+
+    def update(self, durations):
+        for key, duration in durations.iteritems():
+            previous = self.durations.get(key)
+            if previous is None:
+                self.durations[key] = duration
+            else:
+                self.durations[key] = previous * (1 - self.weight) + duration * self.weight
+
+    def save(self):
+        if self.path:
+            write_atomic(self.path, json.dumps(self.durations, indent=2, sort_keys=True))
+
+
+class HostState(object):
+    """
+    Number of items running on a host, and how many may run at once. The limit is max_limit, unless it is adaptive:
+    it then starts at 1 and doubles with every item that finishes in time, until the first item is late. From then on
+    it grows by 1 per item in time, and halves for every late or failed item.
+    """
+
+    def __init__(self, max_limit, adaptive=False):
+        self.max_limit = max_limit
+        self.adaptive = adaptive
+        self.limit = 1 if adaptive else max_limit
+        self.running = 0
+        self.backed_off = False
+
+    def has_room(self):
+        return self.running < self.limit
+
+    def finished(self, in_time):
+        if not self.adaptive:
+            return
+        if in_time:
+            self.limit = min(self.limit * 2 if not self.backed_off else self.limit + 1, self.max_limit)
+        else:
+            self.limit = max(self.limit // 2, 1)
+            self.backed_off = True
+
+
+class Scheduler(object):
+    """
+    Runs a function on items from a number of threads, longest expected items first, without running more than the
+    limit of items on any one host at once.
+
+    An item is late when it takes more than slowdown times as long as it did in earlier runs. Items that did not run
+    before are never late, but are started first, as they may well be the longest.
+    """
+
+    def __init__(self, max_threads, max_per_host=None, expected=None, slowdown=2.0, adaptive=False):
+        """
+        :param max_per_host: maximum number of items running on a host at once. max_threads when None
+        :param expected: dict of item_key() to the number of seconds the item is expected to take
+        :param adaptive: start items one at a time per host, and run more at once while they finish in time, up to
+                         max_per_host. See HostState
+        """
+        self.max_threads = max_threads
+        self.max_per_host = max_per_host or max_threads
+        self.adaptive = adaptive
+        self.expected = expected or dict()
+        self.slowdown = slowdown
+        self.durations = dict()
+        self._condition = threading.Condition()
+
+    def run(self, func, items):
+        """
+        Call func on every item.
+
+        :return: the results, in the order of items, with those of Failures unwrapped. If any call raised, the first
+                 exception is raised once all items are done.
+        """
+        self._items = items
+        self._pending = order_longest_first(items, self.expected)
+        self._hosts = dict((host, HostState(self.max_per_host, self.adaptive))
+                           for host in set(item_host(item) for item in items))
+        self._results = [None] * len(items)
+        self._errors = list()
+        threads = [threading.Thread(target=self._work, args=(func,), name='Scheduler-%d' % i)
+                   for i in xrange(min(self.max_threads, len(items)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Joining with a timeout keeps the main thread responsive to KeyboardInterrupt
+            while thread.is_alive():
+                thread.join(1)
+        if self._errors:
+            exc_type, exc_value, exc_traceback = self._errors[0]
+            raise exc_type, exc_value, exc_traceback
+        return self._results
+
+    def _work(self, func):
+        while True:
+            index = self._take()
+            if index is None:
+                return
+            item = self._items[index]
+            start = time.time()
+            failed = False
+            try:
+                result = func(item)
+                if isinstance(result, Failure):
+                    result, failed = result.result, True
+                self._results[index] = result
+                error = None
+            except Exception:
+                error = sys.exc_info()
+            self._finish(index, time.time() - start, error, failed)
+
+    def _take(self):
+        """
+        Wait for the first pending item whose host has room, and return its index. None when there are no items left.
+        """
+        with self._condition:
+            while self._pending:
+                for position, index in enumerate(self._pending):
+                    host = self._hosts[item_host(self._items[index])]
+                    if host.has_room():
+                        host.running += 1
+                        del self._pending[position]
+                        return index
+                self._condition.wait(1)
+            return None
+
+    def _finish(self, index, duration, error, failed=False):
+        item = self._items[index]
+        key = item_key(item)
+        expected = self.expected.get(key)
+        with self._condition:
+            host = self._hosts[item_host(item)]
+            host.running -= 1
+            succeeded = error is None and not failed
+            host.finished(succeeded and (expected is None or duration <= expected * self.slowdown))
+            if succeeded:
+                # A database that fails fast says nothing about how long it takes
+                self.durations[key] = duration
+            if error is not None:
+                self._errors.append(error)
+            self._condition.notify_all()
+
+
+def order_longest_first(items, expected):
+    """
+    :return: the indexes of items, items that did not run before first and then longest expected first
+    """
+    def sort_key(index):
+        duration = expected.get(item_key(items[index]))
+        return duration is not None, -(duration or 0)
+
+    return sorted(xrange(len(items)), key=sort_key)
+
+
+def balance(items, expected, partitions):
+    """
+    Split the indexes of items into partitions with about the same expected total duration, longest items first.
+    Items that did not run before count as taking the average time.
+    """
+    known = [duration for duration in (expected.get(item_key(item)) for item in items) if duration is not None]
+    default = sum(known) / len(known) if known else 1.0
+    loads = [[0.0, []] for _ in xrange(partitions)]
+    for index in order_longest_first(items, expected):
+        load = min(loads, key=lambda partition: partition[0])
+        load[0] += expected.get(item_key(items[index]), default)
+        load[1].append(index)
+    return [indexes for _, indexes in loads if indexes]
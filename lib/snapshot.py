@@ -0,0 +1,200 @@
+"""
+Versioned snapshot format for reference databases.
+
+Layout, integers big endian:
+
+    magic       8 bytes, 'PGTSNAP\\n'
+    version     4 bytes
+    toc offset  8 bytes
+    tables      one JSON document per table, back to back
+    toc         JSON document up to the end of the file
+
+The table of contents holds free form metadata, the database attributes and procedures, the object type and
+attribute name mapping of every kind of table attribute, and the name, fingerprint, offset and length of every table.
+Being plain JSON, a snapshot can be read without this package.
+
+Tables are decoded on first access, from a read only memory map, so a run only pays for the tables it compares and
+processes reading the same snapshot share its pages. The map stays open until the Snapshot is closed, so its tables
+can only be loaded until then.
+"""
+import json
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+
+from lib import pg_objects
+from lib.exception import SnapshotException
+from lib.pg_objects import Database, Table
+
+MAGIC = 'PGTSNAP\n'
+VERSION = 1
+HEADER = struct.Struct('>IQ')
+
+# Attributes that are written as lists of objects instead of plain values
+OBJECT_LISTS = Table.attribute_lists + ('procedures',)
+
+
+def is_snapshot(path):
+    with open(path, 'rb') as snapshot_file:
+        return snapshot_file.read(len(MAGIC)) == MAGIC
+
+
+def write_snapshot(database, out_path, meta=None):
+    """
+    :param meta: a JSON serializable dict stored along with the database, see Snapshot.meta
+    """
+    kinds = dict()
+    toc_tables = list()
+    with open(out_path, 'wb') as out_file:
+        out_file.write(MAGIC)
+        out_file.write(HEADER.pack(VERSION, 0))
+        for table in database.tables:
+            table.load()
+            document = _dumps(_object_state(table, kinds, skip=('fingerprint',)))
+            toc_tables.append(OrderedDict([('name', table.name),
+                                           ('fingerprint', getattr(table, 'fingerprint', None)),
+                                           ('offset', out_file.tell()),
+                                           ('length', len(document))]))
+            out_file.write(document)
+
+        toc_offset = out_file.tell()
+        database_state = _object_state(database, kinds, skip=('tables',))
+        out_file.write(_dumps(OrderedDict([('version', VERSION),
+                                           ('meta', meta or dict()),
+                                           ('database', database_state),
+                                           ('kinds', kinds),
+                                           ('tables', toc_tables)])))
+        out_file.seek(len(MAGIC))
+        out_file.write(HEADER.pack(VERSION, toc_offset))
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            if snapshot_file.read(len(MAGIC)) != MAGIC:
+                raise SnapshotException("%s is not a snapshot" % path)
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            version, toc_offset = HEADER.unpack_from(self.map, len(MAGIC))
+            if version > VERSION:
+                raise SnapshotException("%s has snapshot version %s, only up to %s is supported" %
+                                        (path, version, VERSION))
+            self.toc = self.decode(toc_offset, len(self.map) - toc_offset)
+        except Exception:
+            self.map.close()
+            raise
+        self.kinds = dict((kind, getattr(pg_objects, spec['object_type']))
+                          for kind, spec in self.toc['kinds'].iteritems())
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Unmap the snapshot. Tables of its database that were not loaded yet can not be loaded anymore.
+        """
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+
+    @property
+    def meta(self):
+        return self.toc.get('meta', dict())
+
+    def get_database(self):
+        database = Database.__new__(Database)
+        self.set_state(database, self.toc['database'])
+        if 'catalog_digests' in database.__dict__:
+            database.catalog_digests = OrderedDict(sorted(database.catalog_digests.iteritems()))
+        database.tables = list()
+        for entry in self.toc['tables']:
+            table = Table.__new__(Table)
+            table.name = entry['name']
+            if entry['fingerprint'] is not None:
+                table.fingerprint = entry['fingerprint']
+            table._loader = TableLoader(self, entry['offset'], entry['length'])
+            database.tables.append(table)
+        return database
+
+    def load_table(self, table, offset, length):
+        with self.lock:
+            if '_loader' not in table.__dict__:
+                # Loaded by another thread in the meantime
+                return
+            if self.map is None:
+                raise SnapshotException("%s is closed, table %s can not be loaded" % (self.path, table.name))
+            self.set_state(table, self.decode(offset, length))
+            del table.__dict__['_loader']
+
+    def set_state(self, obj, state):
+        for attr_name, value in state.iteritems():
+            if attr_name in OBJECT_LISTS and value:
+                object_type = self.kinds[attr_name]
+                value = [self.make_object(object_type, attributes) for attributes in value]
+            obj.__dict__[attr_name] = value
+
+    def make_object(self, object_type, attributes):
+        obj = object_type.__new__(object_type)
+        obj.__setstate__(attributes)
+        return obj
+
+    def decode(self, offset, length):
+        try:
+            return to_str(json.loads(self.map[offset:offset + length]))
+        except ValueError, e:
+            raise SnapshotException("%s is corrupt: %s" % (self.path, e))
+
+
+class TableLoader(object):
+    def __init__(self, snapshot, offset, length):
+        self.snapshot = snapshot
+        self.offset = offset
+        self.length = length
+
+    def load(self, table):
+        self.snapshot.load_table(table, self.offset, self.length)
+
+
+def _object_state(obj, kinds, skip=()):
+    state = OrderedDict()
+    for attr_name, value in sorted(obj.__dict__.iteritems()):
+        if attr_name in skip or attr_name.startswith('_'):
+            continue
+        if attr_name in OBJECT_LISTS:
+            value = [_attribute_state(o, attr_name, kinds) for o in value]
+        state[attr_name] = value
+    return state
+
+
+def _attribute_state(obj, kind, kinds):
+    # The type and name mapping are the same for every object of a kind, so they are stored once per kind
+    kinds.setdefault(kind, OrderedDict([('object_type', obj.object_type.__name__),
+                                        ('remap_attr_names', obj.remap_attr_names)]))
+    return OrderedDict(sorted(obj.__getstate__().iteritems()))
+
+
+def _dumps(document):
+    try:
+        return json.dumps(document, separators=(',', ':'))
+    except TypeError, e:
+        raise SnapshotException("Can not store in a snapshot: %s" % e)
+
+
+def to_str(value):
+    """
+    Turn the unicode strings json returns back into the byte strings psycopg2 returns.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [to_str(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((to_str(k), to_str(v)) for k, v in value.iteritems())
+    return value
@@ -1,11 +1,33 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from lib.exception import ConfigException
-from lib.pg_objects import DatabaseObject
+from lib.pg_objects import CATALOG_KIND_TYPES, DatabaseObject, slot_names
 from lib.util import get_subclasses
 
 ColumnInfo = namedtuple('ColumnInfo', ['table_name', 'column_name', 'expected', 'found'])
 
+# A single action of an ALTER TABLE statement, eg ALTER COLUMN "x" SET NOT NULL. only is True for ALTER TABLE ONLY.
+# Actions on a table with a different only get a statement each, as ONLY applies to the whole statement.
+AlterAction = namedtuple('AlterAction', ['table_name', 'only', 'action'])
+
+SQL_ALTER_TABLE = """
+    ALTER TABLE %(only)s"%(table_name)s"
+    %(actions)s
+    """
+
+
+def alter_table_statements(actions):
+    """
+    Combine AlterActions into one ALTER TABLE statement per table, in the order the tables first occur.
+    """
+    tables = OrderedDict()
+    for action in actions:
+        tables.setdefault((action.table_name, action.only), []).append(action.action)
+    return [SQL_ALTER_TABLE % dict(only='ONLY ' if only else '',
+                                   table_name=table_name,
+                                   actions=',\n    '.join(table_actions))
+            for (table_name, only), table_actions in tables.iteritems()]
+
 
 class Strategy(object):
     """
@@ -29,6 +51,21 @@ class Strategy(object):
         """
         raise NotImplementedError("You must implement execute()!")
 
+    def alter_actions(self, diff_node):
+        """
+        Strategies that alter tables can implement this method to return the AlterActions for diff_node instead of
+        executing them. PGTransform then combines the actions of all strategies on a table into a single ALTER TABLE
+        statement, so that the table is locked and rewritten at most once. None means execute() must be called.
+
+        :param diff_node: the diff node to return actions for
+        :return: a list of AlterActions, or None
+        """
+        return None
+
+    def execute_alter_actions(self, cursor, actions):
+        for statement in alter_table_statements(actions):
+            cursor.execute(statement)
+
     @property
     def target(self):
         """
@@ -42,6 +79,23 @@ class Strategy(object):
     def name(self):
         return self.__class__.__name__
 
+    @property
+    def kinds(self):
+        """
+        The kinds of catalog objects, as in SchemaCatalog.bulk_queries, that this strategy can act on: those of the
+        targeted type, or of the types with the targeted attribute. Table names are always included. None if the
+        target is not an attribute of any catalog object, so everything has to be introspected.
+        """
+        target = self.target
+        kinds = set(['tables'])
+        for kind, object_types in CATALOG_KIND_TYPES.iteritems():
+            for object_type in object_types:
+                if target is object_type or (isinstance(target, basestring) and target in slot_names(object_type)):
+                    kinds.add(kind)
+        if len(kinds) == 1 and target not in CATALOG_KIND_TYPES['tables']:
+            return None
+        return kinds
+
     def get_column_info(self, diff_node):
         table_name = diff_node.parent.parent.name
         column_name = diff_node.parent.name
@@ -3,6 +3,7 @@ import functools
 import inspect
 import os
 import sys
+import tempfile
 from imp import find_module
 from types import ModuleType
 
@@ -35,6 +36,14 @@ def pickle_database(database, out_path):
         pickle.dump(database, out_file, pickle.HIGHEST_PROTOCOL)
 
 
+def write_atomic(path, content):
+    # Scrapers may read the file at any time, so it is replaced at once
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as out_file:
+        out_file.write(content)
+    os.rename(tmp_path, path)
+
+
 def synchronized(lock=None):
     """
     Decorator for performing synchronized method calls.
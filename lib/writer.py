@@ -1,9 +1,69 @@
 #!/usr/bin/env python
+import Queue
+import hashlib
+import json
+import sys
+import threading
+
+from lib.diff import iter_tree, iter_tree_lines
+from lib.metrics import metrics
 
 
 class OutputWriter(object):
+    """
+    Writing is split in two steps: render_stream() turns a stream of differences, as generated by
+    DatabaseObject.iter_diffs(), into picklable payloads, and write_rendered() outputs them. Rendering can then happen
+    on the thread or process that compared the database, while a single QueuedWriter does all the output.
+
+    The payloads of a database are only part of the output once end() is called for it. If the stream of
+    differences fails halfway, discard() drops what was written of it instead.
+    """
+
+    def __init__(self, db_name=None):
+        self.db_name = db_name
+
     def write(self, database_diffs):
-        raise NotImplementedError("You must implement write()!")
+        self.write_stream(self.db_name, iter_tree(database_diffs), database_diffs.name)
+
+    def write_stream(self, db_name, diff_stream, root_name):
+        with metrics.timer('write', database=db_name):
+            try:
+                for i, payload in enumerate(self.render_stream(diff_stream, root_name)):
+                    self.write_rendered(db_name, payload, append=i > 0)
+            except Exception:
+                self.discard(db_name)
+                raise
+            self.end(db_name)
+            self.flush()
+
+    def render_stream(self, diff_stream, root_name):
+        """
+        Generate the payloads for a stream of (path, leaf) differences, at least one even if there are none.
+
+        :param root_name: the name of the object the differences were found on
+        """
+        raise NotImplementedError("You must implement render_stream()!")
+
+    def write_rendered(self, db_name, payload, append=False):
+        """
+        :param append: False for the first payload of a database, True for the ones that follow it
+        """
+        raise NotImplementedError("You must implement write_rendered()!")
+
+    def end(self, db_name):
+        """
+        Make the payloads written for db_name part of the output, replacing its earlier results.
+        """
+
+    def discard(self, db_name):
+        """
+        Drop the payloads written for db_name since its first one, keeping its earlier results.
+        """
+
+    def flush(self):
+        """
+        Make everything written so far durable.
+        """
 
     def visit(self, node, func, **func_kwargs):
         for child in node.children:
@@ -15,17 +75,37 @@ class OutputWriter(object):
 
 class STDOUTWriter(OutputWriter):
     """
-    Prints the difference tree to STDOUT
+    Prints the difference tree to STDOUT. A database is rendered as a single payload, so the output of databases
+    compared at the same time does not interleave, and nothing is printed for a stream that fails.
     """
-    def write(self, database_diffs):
-        if len(database_diffs) > 0:
-            print database_diffs.to_tree()
+    def render_stream(self, diff_stream, root_name):
+        lines = list(iter_tree_lines(root_name, diff_stream))
+        yield "".join(lines) if lines else None
+
+    def write_rendered(self, db_name, payload, append=False):
+        if payload is not None:
+            print payload
+
+    def flush(self):
+        sys.stdout.flush()
 
 
 class SQLightWriter(OutputWriter):
     """
-    Writes the difference tree to a SQLite database.
+    Writes the differences to a SQLite database, in payloads of at most chunk_size rows.
+
+    Every distinct difference is stored once in the difference table, and database_difference maps databases to
+    their differences. Each database gets a fingerprint of its set of differences, so databases that drifted the same
+    way can be grouped on it. The differences view has the shape of the table earlier versions wrote, which is
+    migrated on first use. Unlike that table, it holds a difference only once per database, even if the comparison
+    found several identical ones.
+
+    Payloads are written to staged_difference, and only replace the results of their database in
+    database_difference on end(), in the same transaction. Results of a comparison that failed halfway, or of a run
+    that died, are never part of the differences view.
     """
+    chunk_size = 1000
+
     SQL_CREATE_TABLE_DATABASE = """
     CREATE TABLE if not exists database(
            id         INTEGER PRIMARY KEY NOT NULL,
@@ -33,6 +113,14 @@ class SQLightWriter(OutputWriter):
     )
     """
 
+    SQL_ADD_COLUMN_FINGERPRINT = """
+    ALTER TABLE database ADD COLUMN fingerprint TEXT
+    """
+
+    SQL_CREATE_INDEX_DATABASE = """
+    CREATE INDEX IF NOT EXISTS database_fingerprint ON database (fingerprint)
+    """
+
     SQL_SELECT_DATABASE = """
     SELECT id FROM database WHERE name == :name
     """
@@ -41,59 +129,238 @@ class SQLightWriter(OutputWriter):
     INSERT INTO database (name) values (:name)
     """
 
-    SQL_CREATE_TABLE_DIFFERENCES = """
-    CREATE TABLE IF NOT EXISTS differences (
+    SQL_CREATE_TABLE_DIFFERENCE = """
+    CREATE TABLE IF NOT EXISTS difference (
         id INTEGER PRIMARY KEY NOT NULL,
+        key TEXT NOT NULL UNIQUE,
         table_name TEXT NOT NULL,
         path TEXT NOT NULL,
         type TEXT NOT NULL,
         expected TEXT,
-        found TEXT,
+        found TEXT
+    )
+    """
+
+    SQL_CREATE_INDEX_DIFFERENCE = """
+    CREATE INDEX IF NOT EXISTS difference_type_table_name ON difference (type, table_name)
+    """
+
+    SQL_CREATE_TABLE_DATABASE_DIFFERENCE = """
+    CREATE TABLE IF NOT EXISTS database_difference (
         database INT NOT NULL,
-        FOREIGN KEY(database) REFERENCES database(id)
+        difference INT NOT NULL,
+        UNIQUE (database, difference),
+        FOREIGN KEY(database) REFERENCES database(id),
+        FOREIGN KEY(difference) REFERENCES difference(id)
+    )
+    """
+
+    SQL_CREATE_INDEX_DATABASE_DIFFERENCE = """
+    CREATE INDEX IF NOT EXISTS database_difference_difference ON database_difference (difference)
+    """
+
+    SQL_CREATE_TABLE_STAGED_DIFFERENCE = """
+    CREATE TABLE IF NOT EXISTS staged_difference (
+        database_name TEXT NOT NULL,
+        difference INT NOT NULL,
+        UNIQUE (database_name, difference),
+        FOREIGN KEY(difference) REFERENCES difference(id)
     )
     """
 
-    SQL_INSERT_DIFFERENCES = """
-    INSERT INTO differences
-    (table_name, path, type, expected, found, database)
+    SQL_CREATE_VIEW_DIFFERENCES = """
+    CREATE VIEW IF NOT EXISTS differences AS
+    SELECT dd.rowid AS id, d.table_name, d.path, d.type, d.expected, d.found, dd.database
+    FROM database_difference dd
+      JOIN difference d ON dd.difference = d.id
+    """
+
+    SQL_SELECT_LEGACY_DIFFERENCES = """
+    SELECT table_name, path, type, expected, found, database FROM differences
+    """
+
+    SQL_INSERT_DIFFERENCE = """
+    INSERT OR IGNORE INTO difference
+    (key, table_name, path, type, expected, found)
     VALUES
-    (:table_name, :path, :type, :expected, :found, :database)
+    (?, ?, ?, ?, ?, ?)
     """
 
-    SQL_DELETE_DIFFERENCES = """
-    DELETE FROM differences WHERE database = :database_id
+    SQL_INSERT_DATABASE_DIFFERENCE = """
+    INSERT OR IGNORE INTO database_difference (database, difference)
+    SELECT ?, id FROM difference WHERE key = ?
     """
 
-    def __init__(self, db_path, db_name):
-        import sqlite3
+    SQL_INSERT_STAGED_DIFFERENCE = """
+    INSERT OR IGNORE INTO staged_difference (database_name, difference)
+    SELECT ?, id FROM difference WHERE key = ?
+    """
 
-        self.db_name = db_name
-        self.connection = sqlite3.connect(db_path)
-        self.connection.row_factory = sqlite3.Row
+    SQL_DELETE_DATABASE_DIFFERENCES = """
+    DELETE FROM database_difference WHERE database = :database_id
+    """
 
-    def write(self, database_diffs):
-        cursor = self.connection.cursor()
-        cursor.execute(self.SQL_CREATE_TABLE_DATABASE)
-        cursor.execute(self.SQL_CREATE_TABLE_DIFFERENCES)
+    SQL_PUBLISH_STAGED_DIFFERENCES = """
+    INSERT OR IGNORE INTO database_difference (database, difference)
+    SELECT :database_id, difference FROM staged_difference WHERE database_name = :name
+    """
+
+    SQL_DELETE_STAGED_DIFFERENCES = """
+    DELETE FROM staged_difference WHERE database_name = :name
+    """
+
+    SQL_SELECT_DIFFERENCE_KEYS = """
+    SELECT d.key
+    FROM database_difference dd
+      JOIN difference d ON dd.difference = d.id
+    WHERE dd.database = :database_id
+    ORDER BY d.key
+    """
+
+    SQL_UPDATE_FINGERPRINT = """
+    UPDATE database SET fingerprint = :fingerprint WHERE id = :database_id
+    """
+
+    def __init__(self, db_path, db_name=None):
+        OutputWriter.__init__(self, db_name)
+        self.db_path = db_path
+        self._connection = None
+        # Databases written since the last flush, whose fingerprint is out of date
+        self._unflushed = set()
+
+    @property
+    def connection(self):
+        """
+        Opened on first use, so writers that only render never touch the file.
+        """
+        if self._connection is None:
+            import sqlite3
 
-        def insert_differences(node, cursor=None, database_id=None):
-            path, table_name = self.get_node_path_name(node)
+            # Worker processes write to the same file, so wait for their locks rather than failing
+            self._connection = sqlite3.connect(self.db_path, timeout=60)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            cursor = self._connection.cursor()
+            cursor.execute(self.SQL_CREATE_TABLE_DATABASE)
+            if 'fingerprint' not in [row['name'] for row in cursor.execute("PRAGMA table_info(database)")]:
+                cursor.execute(self.SQL_ADD_COLUMN_FINGERPRINT)
+            cursor.execute(self.SQL_CREATE_INDEX_DATABASE)
+            cursor.execute(self.SQL_CREATE_TABLE_DIFFERENCE)
+            cursor.execute(self.SQL_CREATE_INDEX_DIFFERENCE)
+            cursor.execute(self.SQL_CREATE_TABLE_DATABASE_DIFFERENCE)
+            cursor.execute(self.SQL_CREATE_INDEX_DATABASE_DIFFERENCE)
+            cursor.execute(self.SQL_CREATE_TABLE_STAGED_DIFFERENCE)
+            self.migrate_legacy_differences(cursor)
+            cursor.execute(self.SQL_CREATE_VIEW_DIFFERENCES)
+            self._connection.commit()
+        return self._connection
+
+    def migrate_legacy_differences(self, cursor):
+        """
+        Move the rows of a differences table written by an earlier version into the normalized tables.
+        """
+        cursor.execute("SELECT type FROM sqlite_master WHERE name = 'differences'")
+        master_row = cursor.fetchone()
+        if master_row is None or master_row['type'] != 'table':
+            return
+        rows = cursor.execute(self.SQL_SELECT_LEGACY_DIFFERENCES).fetchall()
+        self.insert_differences(cursor, [(row['database'], tuple(row)[:5]) for row in rows])
+        self._unflushed.update(row['database'] for row in rows)
+        cursor.execute("DROP TABLE differences")
+        self.update_fingerprints(cursor)
+
+    def render_stream(self, diff_stream, root_name):
+        """
+        :return: a generator of lists of (table_name, path, type, expected, found) rows
+        """
+        rows = list()
+        chunks = 0
+        for path, node in diff_stream:
+            path_name, table_name = self.get_path_name(path, node)
             expected = repr(node.data.expected) if node.data.expected else None
             found = repr(node.data.found) if node.data.found else None
-            cursor.execute(self.SQL_INSERT_DIFFERENCES, {'table_name': table_name,
-                                                         'path': path,
-                                                         'name': node.name,
-                                                         'type': node.object_type.__name__,
-                                                         'expected': expected,
-                                                         'found': found,
-                                                         'database': database_id})
-
-        database_id = self.upsert_database(cursor, self.db_name)
-        cursor.execute(self.SQL_DELETE_DIFFERENCES, {'database_id': database_id})
-        self.visit(database_diffs, insert_differences, cursor=cursor, database_id=database_id)
+            rows.append((table_name, path_name, node.object_type.__name__, expected, found))
+            if len(rows) >= self.chunk_size:
+                yield rows
+                rows = list()
+                chunks += 1
+        if rows or not chunks:
+            yield rows
+
+    def write_rendered(self, db_name, payload, append=False):
+        cursor = self.connection.cursor()
+        if not append:
+            # Left over from an attempt that failed
+            cursor.execute(self.SQL_DELETE_STAGED_DIFFERENCES, {'name': db_name})
+        self.insert_differences(cursor, [(db_name, row) for row in payload], staged=True)
+
+    def end(self, db_name):
+        cursor = self.connection.cursor()
+        database_id = self.upsert_database(cursor, db_name)
+        cursor.execute(self.SQL_DELETE_DATABASE_DIFFERENCES, {'database_id': database_id})
+        cursor.execute(self.SQL_PUBLISH_STAGED_DIFFERENCES, {'database_id': database_id, 'name': db_name})
+        cursor.execute(self.SQL_DELETE_STAGED_DIFFERENCES, {'name': db_name})
+        self._unflushed.add(database_id)
+
+    def discard(self, db_name):
+        self.connection.execute(self.SQL_DELETE_STAGED_DIFFERENCES, {'name': db_name})
+
+    def insert_differences(self, cursor, database_rows, staged=False):
+        """
+        :param database_rows: a list of (database, (table_name, path, type, expected, found)) tuples. database is
+                              the id of the database, or its name if staged
+        :param staged: map the differences to their database in staged_difference instead of database_difference
+        """
+        keyed = [(database, self.get_difference_key(row), row) for database, row in database_rows]
+        cursor.executemany(self.SQL_INSERT_DIFFERENCE, [(key,) + tuple(row) for _, key, row in keyed])
+        cursor.executemany(self.SQL_INSERT_STAGED_DIFFERENCE if staged else self.SQL_INSERT_DATABASE_DIFFERENCE,
+                           [(database, key) for database, key, _ in keyed])
+
+    def get_difference_key(self, row):
+        return hashlib.md5(json.dumps(list(row))).hexdigest()
+
+    def flush(self):
+        self.update_fingerprints(self.connection.cursor())
         self.connection.commit()
 
+    def update_fingerprints(self, cursor):
+        for database_id in self._unflushed:
+            digest = hashlib.md5()
+            for row in cursor.execute(self.SQL_SELECT_DIFFERENCE_KEYS, {'database_id': database_id}).fetchall():
+                digest.update(row['key'])
+            cursor.execute(self.SQL_UPDATE_FINGERPRINT, {'fingerprint': digest.hexdigest(),
+                                                         'database_id': database_id})
+        self._unflushed.clear()
+
+    SQL_SELECT_DATABASE_NAMES = """
+    SELECT id, name FROM database ORDER BY name
+    """
+
+    SQL_SELECT_DATABASE_ROWS = """
+    SELECT d.table_name, d.path, d.type, d.expected, d.found
+    FROM database_difference dd
+      JOIN difference d ON dd.difference = d.id
+    WHERE dd.database = :database_id
+    """
+
+    def merge(self, partial_path):
+        """
+        Copy the results of every database in the SQLite file at partial_path, as written by another SQLightWriter,
+        replacing the results this file has for them.
+
+        :return: the number of databases merged
+        """
+        partial = SQLightWriter(partial_path)
+        databases = partial.connection.execute(self.SQL_SELECT_DATABASE_NAMES).fetchall()
+        for database in databases:
+            rows = partial.connection.execute(self.SQL_SELECT_DATABASE_ROWS, {'database_id': database['id']})
+            self.write_rendered(database['name'], [tuple(row) for row in rows], append=False)
+            self.end(database['name'])
+        partial.connection.close()
+        self.flush()
+        return len(databases)
+
     def upsert_database(self, cursor, database_name):
         cursor.execute(self.SQL_SELECT_DATABASE, {'name': database_name})
         result = cursor.fetchone()
@@ -103,9 +370,121 @@ class SQLightWriter(OutputWriter):
             result = cursor.fetchone()
         return result['id']
 
-    def get_node_path_name(self, node):
-        segments = [node.name]
-        while node.parent.parent:
-            node = node.parent
-            segments.append(node.name)
-        return ".".join(reversed(segments)), node.name
+    def get_path_name(self, path, node):
+        segments = [obj.name for obj in path] + [node.name]
+        return ".".join(segments), segments[0]
+
+
+class QueuedWriter(object):
+    """
+    Feeds rendered results to a single long lived writer on a dedicated thread, so that the threads and processes
+    comparing databases never wait on output.
+    """
+
+    def __init__(self, writer, queue=None, flush_every=100, on_finished=None):
+        """
+        :param writer: the OutputWriter to write with. Only used on the writer thread.
+        :param queue: the queue to read results from. Pass a multiprocessing.Queue to accept results from worker
+                      processes forked after this writer is created.
+        :param flush_every: number of databases after which the writer is flushed, if results keep coming
+        :param on_finished: called on the writer thread with the key passed to finish(), once everything queued
+                            before it is written and flushed
+        """
+        self.writer = writer
+        self.queue = queue if queue is not None else Queue.Queue()
+        self.flush_every = flush_every
+        self.on_finished = on_finished
+        self.thread = threading.Thread(target=self._run, name='QueuedWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, db_name, payload, append=False, key=None):
+        """
+        :param key: the item_key() of the database, to record the time spent writing its results under
+        """
+        self.queue.put(('write', db_name, payload, append, key))
+
+    def finish(self, db_name, key=None):
+        """
+        Mark the results of db_name as complete, so they become part of the output. on_finished is called with key
+        once they are flushed, unless writing them failed. The time spent is recorded under key.
+        """
+        self.queue.put(('finished', db_name, key))
+
+    def discard(self, db_name):
+        """
+        Drop the results put for db_name so far, as the comparison that produced them failed.
+        """
+        self.queue.put(('discard', db_name))
+
+    def close(self):
+        """
+        Write everything queued so far and stop the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        unflushed = 0
+        # Keys passed to finish() that wait for the next flush, and databases whose results could not be written
+        finished = list()
+        failed = set()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if item[0] == 'finished':
+                _, db_name, key = item
+                if db_name in failed:
+                    failed.discard(db_name)
+                    self._discard(db_name)
+                else:
+                    try:
+                        with metrics.timer('write', database=key or db_name):
+                            self.writer.end(db_name)
+                        unflushed += 1
+                        if key is not None:
+                            finished.append(key)
+                    except Exception, e:
+                        sys.stderr.write("Failed writing results for %s: %s\n" % (db_name, e))
+            elif item[0] == 'discard':
+                _, db_name = item
+                failed.discard(db_name)
+                self._discard(db_name)
+            else:
+                _, db_name, payload, append, key = item
+                if not append:
+                    failed.discard(db_name)
+                try:
+                    with metrics.timer('write', database=key or db_name):
+                        self.writer.write_rendered(db_name, payload, append=append)
+                    unflushed += 1
+                except Exception, e:
+                    sys.stderr.write("Failed writing results for %s: %s\n" % (db_name, e))
+                    failed.add(db_name)
+            if (unflushed or finished) and (unflushed >= self.flush_every or self.queue.empty()):
+                self._flush(finished)
+                unflushed = 0
+        self._flush(finished)
+
+    def _discard(self, db_name):
+        try:
+            self.writer.discard(db_name)
+        except Exception, e:
+            sys.stderr.write("Failed discarding results for %s: %s\n" % (db_name, e))
+
+    def _flush(self, finished):
+        try:
+            self.writer.flush()
+        except Exception, e:
+            sys.stderr.write("Failed writing results: %s\n" % e)
+            return
+        finally:
+            keys = list(finished)
+            del finished[:]
+        if self.on_finished is not None:
+            for key in keys:
+                try:
+                    self.on_finished(key)
+                except Exception, e:
+                    sys.stderr.write("Failed finishing results for %s: %s\n" % (key, e))
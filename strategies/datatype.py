@@ -1,19 +1,20 @@
-from lib.strategy import Strategy, AttributeStrategy
+from lib.strategy import Strategy, AttributeStrategy, AlterAction
 from lib.util import strat_print_success
 
 
 class DatatypeStrategy(AttributeStrategy):
-    SQL_DATATYPE = """
-    ALTER TABLE "%(table_name)s" alter column "%(column_name)s" type %(expected)s
-    """
+    ACTION_DATATYPE = """alter column "%(column_name)s" type %(expected)s"""
 
     def __init__(self, **kwargs):
         Strategy.__init__(self, **kwargs)
 
     def execute(self, cursor, diff_node):
+        self.execute_alter_actions(cursor, self.alter_actions(diff_node))
+
+    def alter_actions(self, diff_node):
         column_info = self.get_column_info(diff_node)
         strat_print_success("SETTING %(table_name)s.%(column_name)s type to %(expected)s" % vars(column_info))
-        cursor.execute(self.SQL_DATATYPE % vars(column_info))
+        return [AlterAction(column_info.table_name, False, self.ACTION_DATATYPE % vars(column_info))]
 
     @property
     def target(self):
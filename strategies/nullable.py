@@ -1,28 +1,27 @@
-from lib.strategy import Strategy, AttributeStrategy
+from lib.strategy import Strategy, AttributeStrategy, AlterAction
 from lib.util import strat_print_success
 
 
 class NotNullableStrategy(AttributeStrategy):
-    SQL_SET_NOT_NULL = """
-    ALTER TABLE "%(table_name)s" ALTER COLUMN "%(column_name)s" SET NOT NULL
-    """
+    ACTION_SET_NOT_NULL = """ALTER COLUMN "%(column_name)s" SET NOT NULL"""
 
-    SQL_SET_NULL = """
-    ALTER TABLE "%(table_name)s" ALTER COLUMN "%(column_name)s" DROP NOT NULL
-    """
+    ACTION_SET_NULL = """ALTER COLUMN "%(column_name)s" DROP NOT NULL"""
 
     def __init__(self, **kwargs):
         Strategy.__init__(self, **kwargs)
 
     def execute(self, cursor, diff_node):
+        self.execute_alter_actions(cursor, self.alter_actions(diff_node))
+
+    def alter_actions(self, diff_node):
         column_info = self.get_column_info(diff_node)
         if column_info.expected is False:
             strat_print_success("Setting %(table_name)s.%(column_name)s to NOT NULL" % vars(column_info))
-            cursor.execute(self.SQL_SET_NOT_NULL % vars(column_info))
+            action = self.ACTION_SET_NOT_NULL
         else:
             strat_print_success("Setting %(table_name)s.%(column_name)s to NULLABLE" % vars(column_info))
-            cursor.execute(self.SQL_SET_NULL % vars(column_info))
-
+            action = self.ACTION_SET_NULL
+        return [AlterAction(column_info.table_name, False, action % vars(column_info))]
 
     @property
     def target(self):
@@ -0,0 +1,89 @@
+"""
+Stand-ins for psycopg2 connections and cursors, so the tests run without a database server.
+"""
+from lib.catalog import SchemaCatalog
+from lib.pg_objects import Database
+
+
+class FakeCursor(object):
+    """
+    Records the statements executed on it. Selects return the rows of the first entry of results whose key occurs in
+    the statement, as dicts like a DictCursor returns.
+    """
+
+    def __init__(self, results=None):
+        self.results = results or dict()
+        self.statements = list()
+        self.rows = list()
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+        self.rows = list()
+        for key, rows in self.results.iteritems():
+            if key in sql:
+                self.rows = [dict(row) for row in rows]
+                break
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, cursor=None):
+        self.fake_cursor = cursor or FakeCursor()
+        self.committed = False
+        self.rolled_back = False
+        self.closed = False
+
+    def cursor(self, **kwargs):
+        return self.fake_cursor
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDBConnection(object):
+    """
+    A DBConnection that hands out a FakeConnection.
+    """
+
+    def __init__(self, database, connection=None):
+        self.database = database
+        self.connection = connection or FakeConnection()
+
+
+def make_catalog(database_name, tables):
+    """
+    A SchemaCatalog as a bulk introspection of database_name fetches it.
+
+    :param tables: a dict of table name to the column rows of the table, as dicts of catalog column to value
+    """
+    catalog = SchemaCatalog(database_name)
+    catalog.add_rows('tables', [dict(catalog_table=name, table_name=name, table_type='BASE TABLE')
+                                for name in sorted(tables)])
+    for name, columns in sorted(tables.iteritems()):
+        catalog.add_rows('columns', [dict(column, catalog_table=name) for column in columns])
+    return catalog
+
+
+def make_database(database_name, tables):
+    """
+    A Database of the given tables, built without a connection. See make_catalog.
+    """
+    database = Database(FakeDBConnection(database_name), catalog=make_catalog(database_name, tables))
+    database.compute_fingerprint()
+    return database
+
+
+def column(name, udt_name='text', is_nullable='YES', column_default=None):
+    return dict(column_name=name, data_type=udt_name, udt_name=udt_name, column_default=column_default,
+                is_nullable=is_nullable, character_maximum_length=None, numeric_precision=None)
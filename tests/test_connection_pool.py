@@ -0,0 +1,41 @@
+from lib.connection_pool import ConnectionPool
+from lib.pg_objects import DBConnection
+from tests.fakes import FakeConnection
+
+
+class FakeDBConnection(DBConnection):
+    def connect(self):
+        return FakeConnection()
+
+
+def db_connection(database, port=5432):
+    return FakeDBConnection('db1', database, 'user', 'password', port=port)
+
+
+def test_connections_are_reused():
+    pool = ConnectionPool()
+    first = db_connection('shop')
+    conn = pool.acquire(first)
+    pool.release(first, conn)
+    assert pool.acquire(db_connection('shop')) is conn
+
+
+def test_cap_per_host():
+    pool = ConnectionPool(max_per_host=1)
+    assert pool.acquire(db_connection('shop')) is not None
+    assert pool.acquire(db_connection('shop'), block=False) is None
+
+
+def test_instances_on_other_ports_have_a_cap_each():
+    pool = ConnectionPool(max_per_host=1)
+    assert pool.acquire(db_connection('shop')) is not None
+    assert pool.acquire(db_connection('shop', port=5433), block=False) is not None
+
+
+def test_idle_connection_to_another_database_makes_room():
+    pool = ConnectionPool(max_per_host=1)
+    shop = db_connection('shop')
+    conn = pool.acquire(shop)
+    pool.release(shop, conn)
+    assert pool.acquire(db_connection('blog'), block=False) is not None
+    assert conn.closed
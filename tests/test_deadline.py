@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from lib.deadline import Deadlines, deadlines, run_with_deadline
+from lib.exception import DeadlineExceeded
+from lib.pg_objects import DBConnection
+from tests.fakes import FakeConnection
+
+
+class CancellableConnection(FakeConnection):
+    def __init__(self):
+        FakeConnection.__init__(self)
+        self.cancelled = 0
+
+    def cancel(self):
+        self.cancelled += 1
+
+
+class FakeDBConnection(DBConnection):
+    def connect(self):
+        return CancellableConnection()
+
+
+def test_check_raises_once_the_deadline_expired():
+    watched = Deadlines(interval=60)
+    with pytest.raises(DeadlineExceeded):
+        with watched.deadline(0.01, 'shop'):
+            watched.check()
+            time.sleep(0.02)
+            watched.check()
+
+
+def test_check_without_deadline():
+    Deadlines().check()
+
+
+def test_expired_checks_are_retried():
+    attempts = list()
+
+    def work():
+        attempts.append(time.time())
+        time.sleep(0.02)
+        deadlines.check()
+        return 'done'
+
+    with pytest.raises(DeadlineExceeded):
+        run_with_deadline(work, 'shop', seconds=0.01, retries=2, backoff=0.001)
+    assert len(attempts) == 3
+
+
+def test_watchdog_cancels_watched_connections():
+    db_connection = FakeDBConnection('db1', 'shop', 'user', 'password')
+    with pytest.raises(DeadlineExceeded):
+        with deadlines.deadline(0.01, 'shop'):
+            conn = db_connection.connection
+            time.sleep(1.2)
+            deadlines.check()
+    assert conn.cancelled == 1
+
+
+def test_closed_connections_are_not_cancelled():
+    db_connection = FakeDBConnection('db1', 'shop', 'user', 'password')
+    with pytest.raises(DeadlineExceeded):
+        with deadlines.deadline(0.01, 'shop'):
+            conn = db_connection.connection
+            db_connection.close()
+            assert not any(db_connection in deadline.connections for deadline in deadlines.active)
+            time.sleep(1.2)
+            deadlines.check()
+    assert conn.cancelled == 0
+    assert conn.closed
@@ -0,0 +1,35 @@
+from lib.diff import build_tree, iter_tree, iter_tree_lines
+from tests.fakes import column, make_database
+
+REFERENCE = {'users': [column('id', 'int4', 'NO'), column('email'), column('name')],
+             'orders': [column('id', 'int4', 'NO'), column('total', 'numeric')],
+             'audit': [column('id', 'int4', 'NO')]}
+
+TARGET = {'users': [column('id', 'int8', 'NO'), column('email', 'varchar', 'NO'), column('nickname')],
+          'orders': [column('id', 'int4', 'NO'), column('total', 'numeric', column_default='0')],
+          'sessions': [column('id', 'int4', 'NO')]}
+
+
+def databases():
+    return make_database('reference', REFERENCE), make_database('target', TARGET)
+
+
+def test_streamed_lines_match_the_tree():
+    reference, target = databases()
+    tree = reference.compare_to(target)
+    assert len(list(iter_tree(tree))) > 5
+    assert "".join(iter_tree_lines(reference.name, reference.iter_diffs(target))) == tree.to_tree()
+
+
+def test_no_lines_without_differences():
+    reference, _ = databases()
+    assert list(iter_tree_lines(reference.name, reference.iter_diffs(make_database('target', REFERENCE)))) == []
+
+
+def test_build_tree_reverses_iter_tree():
+    reference, target = databases()
+    tree = reference.compare_to(target)
+    rebuilt = build_tree(tree.name, iter_tree(tree))
+    assert rebuilt.to_tree() == tree.to_tree()
+    assert [(tuple(n.name for n in path), leaf.name) for path, leaf in iter_tree(rebuilt)] == \
+        [(tuple(n.name for n in path), leaf.name) for path, leaf in iter_tree(tree)]
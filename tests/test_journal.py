@@ -0,0 +1,112 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from input_plugins.input_plugin import ConnectionConfig
+from lib.exception import JournalException
+from lib.journal import Journal
+from lib.parallel import run_queue
+from lib.scheduler import item_host, item_key
+
+
+def config(database, host='db1'):
+    return ConnectionConfig(database, 'user', host, 'password', 5432)
+
+
+def claim_all(path, worker, claimed):
+    journal = Journal(path, 'pg-compare')
+    while True:
+        key = journal.claim(worker, lease=3600)
+        if key is None:
+            return
+        claimed.put(key)
+
+
+def test_concurrent_claims_take_every_database_once(tmpdir):
+    path = str(tmpdir.join('journal.sqlite'))
+    items = [config('db%03d' % i, host='db%d' % (i % 3)) for i in xrange(100)]
+    Journal(path, 'pg-compare').add(items)
+    claimed = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=claim_all, args=(path, 'w%d' % i, claimed)) for i in xrange(4)]
+    for worker in workers:
+        worker.start()
+    keys = [claimed.get(timeout=60) for _ in items]
+    for worker in workers:
+        worker.join()
+    assert sorted(keys) == sorted(item_key(item) for item in items)
+    assert claimed.empty()
+
+
+def test_claim_longest_first(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.sqlite')), 'pg-compare')
+    items = [config('short'), config('long'), config('new')]
+    journal.add(items, expected={'db1:5432/short': 1.0, 'db1:5432/long': 10.0})
+    assert [journal.claim('w', lease=3600) for _ in xrange(4)] == ['db1:5432/new', 'db1:5432/long',
+                                                                   'db1:5432/short', None]
+
+
+def test_claim_again_after_lease(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.sqlite')), 'pg-compare')
+    journal.add([config('a')])
+    assert journal.claim('w1', lease=3600) == 'db1:5432/a'
+    assert journal.claim('w2', lease=3600) is None
+    time.sleep(0.01)
+    assert journal.claim('w2', lease=0.001) == 'db1:5432/a'
+
+
+def test_claim_skips_excluded_hosts(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.sqlite')), 'pg-compare')
+    journal.add([config('a', host='db1'), config('b', host='db2')], expected={'db1:5432/a': 2.0})
+    assert journal.claim('w', lease=3600, excluded_hosts=[('db1', 5432)]) == 'db2:5432/b'
+    assert journal.claim('w', lease=3600, excluded_hosts=[('db1', 5432)]) is None
+    assert journal.claim('w', lease=3600) == 'db1:5432/a'
+
+
+def test_finished_journal_is_refused(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.sqlite')), 'pg-compare')
+    items = [config('a'), config('b')]
+    journal.add(items)
+    journal.done(items[0])
+    journal.failed(items[1], 'refused')
+    with pytest.raises(JournalException):
+        journal.add(items)
+
+
+def test_resume_processes_failed_databases_again(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.sqlite')), 'pg-compare')
+    items = [config('a'), config('b')]
+    journal.add(items)
+    journal.done(items[0])
+    journal.failed(items[1], 'refused')
+    journal.add(items, resume=True)
+    assert journal.claim('w', lease=3600) == 'db1:5432/b'
+    assert journal.claim('w', lease=3600) is None
+
+
+def test_run_queue_only_claims_on_hosts_with_room(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.sqlite')), 'pg-compare')
+    items = [config('db%02d' % i, host='db%d' % (i % 2)) for i in xrange(12)]
+    running = dict()
+    most = dict()
+    started = dict()
+    lock = threading.Lock()
+
+    def process(item):
+        host = item_host(item)
+        with lock:
+            started[item_key(item)] = time.time()
+            running[host] = running.get(host, 0) + 1
+            most[host] = max(most.get(host, 0), running[host])
+        time.sleep(0.05)
+        with lock:
+            running[host] -= 1
+        return item.database
+
+    results = run_queue(process, items, journal, 'w', max_threads=6, max_per_host=2)
+    assert sorted(results) == sorted(item.database for item in items)
+    assert most == {('db0', 5432): 2, ('db1', 5432): 2}
+    # The lease of every database started when it did, not while it waited for its host
+    claimed = dict(journal.connection.execute("SELECT database, started FROM journal").fetchall())
+    assert all(started[key] - claimed[key] < 0.04 for key in started)
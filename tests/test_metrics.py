@@ -0,0 +1,36 @@
+from input_plugins.input_plugin import ConnectionConfig
+from lib.metrics import metered, metrics
+from lib.scheduler import Failure
+from lib.writer import QueuedWriter, STDOUTWriter
+
+
+@metered
+def process(arg_tuple):
+    metrics.count('tables', arg_tuple[1])
+    if arg_tuple[1] < 0:
+        return Failure()
+
+
+def test_databases_with_the_same_name_on_different_hosts_are_kept_apart():
+    primary = process((ConnectionConfig('shop', 'user', 'db1', 'password', 5432), 3))
+    replica = process((ConnectionConfig('shop', 'user', 'db2', 'password', 5432), 5))
+    assert primary[0] == 'db1:5432/shop'
+    assert primary[1].counters == {'tables': 3}
+    assert replica[0] == 'db2:5432/shop'
+    assert replica[1].counters == {'tables': 5}
+
+
+def test_metered_passes_failures_on():
+    result = process((ConnectionConfig('shop', 'user', 'db1', 'password', 5432), -1))
+    assert isinstance(result, Failure)
+    assert result.result[0] == 'db1:5432/shop'
+
+
+def test_queued_writer_records_time_under_the_key():
+    output = QueuedWriter(STDOUTWriter())
+    output.put('shop', None, key='db1:5432/shop')
+    output.finish('shop', 'db1:5432/shop')
+    output.close()
+    writer_metrics = metrics.pop('db1:5432/shop')
+    assert 'write' in writer_metrics.phases
+    assert metrics.pop('shop') is None
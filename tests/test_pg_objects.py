@@ -0,0 +1,95 @@
+import copy_reg
+from collections import OrderedDict
+
+from lib.pg_objects import Column, Database
+from lib.provider import PickleProvider
+from lib.snapshot import Snapshot, write_snapshot
+from lib.util import pickle_database
+from tests.fakes import FakeConnection, FakeCursor, FakeDBConnection, column, make_database
+
+TABLES = {'users': [column('id', 'int4', 'NO'), column('email')],
+          'orders': [column('id', 'int4', 'NO')]}
+
+
+def snapshot_reference(tmpdir):
+    reference = make_database('reference', TABLES)
+    reference.catalog_digests = OrderedDict([('orders', 'digest-orders'), ('users', 'digest-users')])
+    path = str(tmpdir.join('reference.snapshot'))
+    write_snapshot(reference, path)
+    return Snapshot(path)
+
+
+def introspect_with_digests(reference):
+    # Only users changed, so only its catalog rows are fetched
+    cursor = FakeCursor({'AS digest': [dict(table_name='orders', digest='digest-orders'),
+                                       dict(table_name='users', digest='digest-changed')],
+                         'information_schema.tables': [dict(catalog_table='users', table_name='users')],
+                         'AS data_type': [dict(column('id', 'int4', 'NO'), catalog_table='users'),
+                                          dict(column('email', 'varchar'), catalog_table='users')]})
+    target = Database(FakeDBConnection('target', FakeConnection(cursor)), reference=reference)
+    target.compute_fingerprint()
+    return target
+
+
+def test_unchanged_tables_are_shared_with_the_reference(tmpdir):
+    with snapshot_reference(tmpdir) as snapshot:
+        reference = snapshot.get_database()
+        target = introspect_with_digests(reference)
+        orders = dict((table.name, table) for table in reference.tables)['orders']
+
+        assert [table.name for table in target.tables] == ['orders', 'users']
+        assert target.tables[0] is orders
+
+        diffs = [(tuple(o.name for o in path), leaf.name) for path, leaf in reference.iter_diffs(target)]
+        assert sorted(diffs) == [(('users', 'email'), 'data_type'), (('users', 'email'), 'udt_name')]
+        # Neither fingerprinting the target nor comparing decoded the shared table
+        assert '_loader' in orders.__dict__
+
+
+def test_fingerprint_skips_unchanged_databases():
+    reference = make_database('reference', TABLES)
+    target = make_database('target', TABLES)
+    assert reference.fingerprint is not None
+    assert reference.fingerprint == target.fingerprint
+    assert list(reference.iter_diffs(target)) == []
+
+    changed = make_database('target', dict(TABLES, orders=[column('id', 'int8', 'NO')]))
+    assert changed.fingerprint != reference.fingerprint
+    assert changed.tables[0].fingerprint != reference.tables[0].fingerprint
+    assert changed.tables[1].fingerprint == reference.tables[1].fingerprint
+
+
+class OldPickle(object):
+    """
+    Pickles as a table attribute did before they had slots: with a __dict__ that holds the object type and name
+    mapping of every object.
+    """
+
+    def __init__(self, object_type, **state):
+        self.object_type = object_type
+        self.state = dict(state, object_type=object_type, remap_attr_names=object_type.remap_attr_names)
+
+    def __reduce_ex__(self, protocol):
+        return copy_reg._reconstructor, (self.object_type, object, None), self.state
+
+
+def test_old_pickles_load_into_slotted_objects(tmpdir):
+    old = make_database('reference', TABLES)
+    for table in old.tables:
+        table.columns = [OldPickle(Column, name=c.name, data_type=c.data_type, udt_name=c.udt_name,
+                                   is_nullable=c.is_nullable, ignore_attr=None) for c in table.columns]
+        del table.fingerprint
+    del old.fingerprint
+    path = str(tmpdir.join('reference.pickle'))
+    pickle_database(old, path)
+
+    provider = PickleProvider(path)
+    loaded = provider.get_database()
+    users = loaded.tables[1]
+    assert type(users.columns[0]) is Column
+    assert not hasattr(users.columns[0], '__dict__')
+    assert users.columns[0].ignore_attr is None
+    assert users.columns[1].attribute_items() == [('name', 'email'), ('data_type', 'text'), ('udt_name', 'text'),
+                                                  ('is_nullable', True)]
+    assert loaded.fingerprint is not None
+    assert list(loaded.iter_diffs(make_database('target', TABLES))) == []
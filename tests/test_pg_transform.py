@@ -0,0 +1,56 @@
+from lib.diff import DiffItem, DiffNode
+from lib.pg_objects import ColumnAttribute, Table
+from lib.pg_transform import PGTransform
+from strategies.column_default import ColumnDefaultStrategy
+from strategies.datatype import DatatypeStrategy
+from strategies.drop_table import DropTableStrategy
+from strategies.nullable import NotNullableStrategy
+from tests.fakes import FakeDBConnection
+
+
+class FakeProvider(object):
+    def __init__(self):
+        self.db_connection = FakeDBConnection('target')
+
+
+def attribute_diff(name, expected, found):
+    return DiffNode(name=name, object_type=ColumnAttribute, data=DiffItem(name, expected, found))
+
+
+def diff_tree():
+    root = DiffNode(name='target')
+    users = DiffNode(name='users')
+    email = DiffNode(name='email')
+    email.append(attribute_diff('udt_name', 'text', 'varchar'))
+    email.append(attribute_diff('is_nullable', False, True))
+    email.append(attribute_diff('column_default', "''::text", None))
+    users.append(email)
+    root.append(users)
+    root.append(DiffNode(name='old_users', object_type=Table, data=DiffItem('old_users', None, 'old_users')))
+    return root
+
+
+def transform(strategies):
+    provider = FakeProvider()
+    PGTransform(provider, diff_tree(), None, 'target', strategies=strategies).transform()
+    return [' '.join(statement.split()) for statement in provider.db_connection.connection.fake_cursor.statements]
+
+
+def test_one_alter_table_per_table_around_drop_table():
+    # Sorted by module name, as get_subclasses() loads them: DropTableStrategy runs between the other two
+    statements = transform([DatatypeStrategy(), DropTableStrategy(), NotNullableStrategy()])
+    assert statements == ['ALTER TABLE "users" alter column "email" type text, ALTER COLUMN "email" SET NOT NULL',
+                          'DROP TABLE "old_users" CASCADE']
+
+
+def test_alter_table_statements_do_not_depend_on_strategy_order():
+    statements = transform([NotNullableStrategy(), DropTableStrategy(), DatatypeStrategy()])
+    assert statements == ['ALTER TABLE "users" ALTER COLUMN "email" SET NOT NULL, alter column "email" type text',
+                          'DROP TABLE "old_users" CASCADE']
+
+
+def test_column_default_does_not_recurse_into_inheriting_tables():
+    statements = transform([ColumnDefaultStrategy(), DatatypeStrategy(), DropTableStrategy(), NotNullableStrategy()])
+    assert statements == ['ALTER TABLE ONLY "users" ALTER COLUMN "email" SET DEFAULT \'\'::text',
+                          'ALTER TABLE "users" alter column "email" type text, ALTER COLUMN "email" SET NOT NULL',
+                          'DROP TABLE "old_users" CASCADE']
@@ -0,0 +1,58 @@
+from input_plugins.input_plugin import ConnectionConfig
+from lib.scheduler import Failure, HostState, Scheduler, balance, order_longest_first
+
+
+def config(database, host='db1', port=5432):
+    return ConnectionConfig(database, 'user', host, 'password', port)
+
+
+def test_run_returns_results_in_item_order():
+    items = [config('a'), config('b', host='db2'), config('c')]
+    assert Scheduler(2).run(lambda item: item.database, items) == ['a', 'b', 'c']
+
+
+def test_failures_are_unwrapped_and_their_durations_not_recorded():
+    items = [config('a'), config('b')]
+    scheduler = Scheduler(2)
+    results = scheduler.run(lambda item: Failure(item.database) if item.database == 'b' else item.database, items)
+    assert results == ['a', 'b']
+    assert scheduler.durations.keys() == ['db1:5432/a']
+
+
+def test_failures_back_off_an_adaptive_host():
+    items = [config(name) for name in 'abcdefgh']
+    scheduler = Scheduler(4, adaptive=True)
+    scheduler.run(lambda item: Failure(), items)
+    assert scheduler._hosts[('db1', 5432)].limit == 1
+    assert scheduler.durations == dict()
+
+
+def test_adaptive_host_state():
+    host = HostState(8, adaptive=True)
+    assert host.limit == 1
+    host.finished(True)
+    host.finished(True)
+    assert host.limit == 4
+    host.finished(False)
+    assert host.limit == 2
+    host.finished(True)
+    assert host.limit == 3
+
+
+def test_host_state_is_fixed_unless_adaptive():
+    host = HostState(8)
+    host.finished(False)
+    assert host.limit == 8
+
+
+def test_order_longest_first():
+    items = [config('a'), config('b'), config('c')]
+    expected = {'db1:5432/a': 1.0, 'db1:5432/c': 5.0}
+    # Databases that did not run before come first
+    assert order_longest_first(items, expected) == [1, 2, 0]
+
+
+def test_balance():
+    items = [config('a'), config('b'), config('c'), config('d')]
+    expected = {'db1:5432/a': 6.0, 'db1:5432/b': 3.0, 'db1:5432/c': 2.0, 'db1:5432/d': 1.0}
+    assert balance(items, expected, 2) == [[0], [1, 2, 3]]
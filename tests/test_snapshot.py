@@ -0,0 +1,65 @@
+import pytest
+
+from lib.exception import SnapshotException
+from lib.provider import PickleProvider
+from lib.snapshot import Snapshot, write_snapshot
+from tests.fakes import column, make_database
+
+
+def reference():
+    return make_database('reference', {'users': [column('id', 'int4', 'NO'), column('email')],
+                                       'orders': [column('id', 'int4', 'NO')]})
+
+
+def test_snapshot_round_trip(tmpdir):
+    path = str(tmpdir.join('reference.snapshot'))
+    database = reference()
+    write_snapshot(database, path, meta=dict(change_stamp='abc'))
+
+    with Snapshot(path) as snapshot:
+        assert snapshot.meta == dict(change_stamp='abc')
+        loaded = snapshot.get_database()
+        assert [table.name for table in loaded.tables] == ['orders', 'users']
+        assert all('_loader' in table.__dict__ for table in loaded.tables)
+        assert list(database.iter_diffs(loaded)) == []
+        loaded.compute_fingerprint()
+        assert loaded.fingerprint == database.fingerprint
+        users = loaded.tables[1]
+        assert [c.name for c in users.columns] == ['id', 'email']
+        assert users.columns[0].is_nullable is False
+
+
+def test_tables_can_not_be_loaded_once_closed(tmpdir):
+    path = str(tmpdir.join('reference.snapshot'))
+    write_snapshot(reference(), path)
+
+    snapshot = Snapshot(path)
+    loaded = snapshot.get_database()
+    loaded.tables[0].load()
+    snapshot.close()
+    snapshot.close()
+    assert snapshot.map is None
+    assert [c.name for c in loaded.tables[0].columns] == ['id']
+    with pytest.raises(SnapshotException):
+        loaded.tables[1].load()
+
+
+def test_pickle_provider_closes_its_snapshot(tmpdir):
+    path = str(tmpdir.join('reference.snapshot'))
+    write_snapshot(reference(), path)
+
+    provider = PickleProvider(path)
+    assert provider.get_database().name == 'reference'
+    provider.close()
+    assert provider.snapshot.map is None
+
+
+def test_newer_snapshot_version_is_refused(tmpdir):
+    path = str(tmpdir.join('reference.snapshot'))
+    write_snapshot(reference(), path)
+    with open(path, 'r+b') as snapshot_file:
+        snapshot_file.seek(8)
+        snapshot_file.write('\x00\x00\x00\x63')
+
+    with pytest.raises(SnapshotException):
+        Snapshot(path)
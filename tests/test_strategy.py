@@ -0,0 +1,25 @@
+from lib.strategy import AlterAction, alter_table_statements
+
+
+def statements(actions):
+    return [' '.join(statement.split()) for statement in alter_table_statements(actions)]
+
+
+def test_actions_are_grouped_per_table_in_order_of_first_occurrence():
+    assert statements([AlterAction('users', False, 'ALTER COLUMN "a" SET NOT NULL'),
+                       AlterAction('orders', False, 'ALTER COLUMN "b" DROP NOT NULL'),
+                       AlterAction('users', False, 'ALTER COLUMN "c" TYPE text')]) == \
+        ['ALTER TABLE "users" ALTER COLUMN "a" SET NOT NULL, ALTER COLUMN "c" TYPE text',
+         'ALTER TABLE "orders" ALTER COLUMN "b" DROP NOT NULL']
+
+
+def test_only_actions_get_their_own_statement():
+    assert statements([AlterAction('users', True, 'ALTER COLUMN "a" SET DEFAULT 0'),
+                       AlterAction('users', False, 'ALTER COLUMN "a" SET NOT NULL'),
+                       AlterAction('users', True, 'ALTER COLUMN "b" DROP DEFAULT')]) == \
+        ['ALTER TABLE ONLY "users" ALTER COLUMN "a" SET DEFAULT 0, ALTER COLUMN "b" DROP DEFAULT',
+         'ALTER TABLE "users" ALTER COLUMN "a" SET NOT NULL']
+
+
+def test_no_actions_no_statements():
+    assert alter_table_statements([]) == []
@@ -0,0 +1,126 @@
+import sqlite3
+
+from lib.diff import DiffItem, DiffNode
+from lib.pg_objects import ColumnAttribute
+from lib.writer import QueuedWriter, SQLightWriter
+
+
+class ComparisonFailed(Exception):
+    pass
+
+
+def column(table, name, attribute, expected, found):
+    path = (DiffNode(name=table), DiffNode(name=name))
+    return path, DiffNode(name=attribute, object_type=ColumnAttribute, data=DiffItem(attribute, expected, found))
+
+
+def diff_stream(count, fail_after=None):
+    for i in xrange(count):
+        if i == fail_after:
+            raise ComparisonFailed("connection lost")
+        yield column('users', 'c%d' % i, 'udt_name', 'text', 'varchar')
+
+
+def differences(writer, db_name):
+    return writer.connection.execute("SELECT d.path FROM differences d JOIN database db ON d.database = db.id "
+                                     "WHERE db.name = ? ORDER BY d.path", (db_name,)).fetchall()
+
+
+def queue_stream(output, writer, db_name, stream):
+    try:
+        for i, payload in enumerate(writer.render_stream(stream, 'reference')):
+            output.put(db_name, payload, append=i > 0)
+    except ComparisonFailed:
+        output.discard(db_name)
+    else:
+        output.finish(db_name)
+
+
+def test_stream_that_fails_leaves_earlier_results(tmpdir):
+    path = str(tmpdir.join('db_diffs.sqlite'))
+    writer = SQLightWriter(path)
+    writer.chunk_size = 2
+    writer.write_stream('target', diff_stream(3), 'reference')
+    try:
+        writer.write_stream('target', diff_stream(5, fail_after=4), 'reference')
+    except ComparisonFailed:
+        pass
+    writer.flush()
+    assert [row['path'] for row in differences(writer, 'target')] == ['users.c0.udt_name', 'users.c1.udt_name',
+                                                                      'users.c2.udt_name']
+    assert writer.connection.execute("SELECT count(*) FROM staged_difference").fetchone()[0] == 0
+
+
+def test_queued_results_are_written_on_finish_only(tmpdir):
+    path = str(tmpdir.join('db_diffs.sqlite'))
+    writer = SQLightWriter(path)
+    writer.chunk_size = 2
+    output = QueuedWriter(writer)
+    queue_stream(output, writer, 'complete', diff_stream(3))
+    queue_stream(output, writer, 'partial', diff_stream(5, fail_after=3))
+    output.close()
+    result = SQLightWriter(path)
+    assert len(differences(result, 'complete')) == 3
+    assert differences(result, 'partial') == []
+    assert [row['name'] for row in result.connection.execute("SELECT name FROM database")] == ['complete']
+
+
+def write_legacy(path):
+    # The layout earlier versions wrote: one differences row per difference found, identical ones included
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE database(id INTEGER PRIMARY KEY NOT NULL, name TEXT NOT NULL)")
+    connection.execute("CREATE TABLE differences (id INTEGER PRIMARY KEY NOT NULL, table_name TEXT NOT NULL, "
+                       "path TEXT NOT NULL, type TEXT NOT NULL, expected TEXT, found TEXT, database INT NOT NULL)")
+    connection.executemany("INSERT INTO database (id, name) VALUES (?, ?)", [(1, 'first'), (2, 'second')])
+    connection.executemany("INSERT INTO differences (table_name, path, type, expected, found, database) "
+                           "VALUES (?, ?, ?, ?, ?, ?)",
+                           [('users', 'users.email.udt_name', 'ColumnAttribute', "'text'", "'varchar'", 1),
+                            ('users', 'users.email.udt_name', 'ColumnAttribute', "'text'", "'varchar'", 1),
+                            ('users', 'users.email.udt_name', 'ColumnAttribute', "'text'", "'varchar'", 2),
+                            ('orders', 'orders', 'Table', "'orders'", None, 2)])
+    connection.commit()
+    connection.close()
+
+
+def test_legacy_differences_are_migrated(tmpdir):
+    path = str(tmpdir.join('db_diffs.sqlite'))
+    write_legacy(path)
+    writer = SQLightWriter(path)
+    assert writer.connection.execute("SELECT type FROM sqlite_master WHERE name = 'differences'").fetchone()[0] == \
+        'view'
+    assert [tuple(row) for row in writer.connection.execute("SELECT database, path, expected, found FROM differences "
+                                                            "ORDER BY database, path")] == \
+        [(1, 'users.email.udt_name', "'text'", "'varchar'"),
+         (2, 'orders', "'orders'", None),
+         (2, 'users.email.udt_name', "'text'", "'varchar'")]
+    assert writer.connection.execute("SELECT count(*) FROM difference").fetchone()[0] == 2
+    fingerprints = [row['fingerprint'] for row in writer.connection.execute("SELECT fingerprint FROM database "
+                                                                            "ORDER BY id")]
+    assert None not in fingerprints and fingerprints[0] != fingerprints[1]
+
+    # Opening it again finds nothing left to migrate
+    writer.connection.close()
+    assert len(differences(SQLightWriter(path), 'second')) == 2
+
+
+def test_merge_replaces_the_results_of_merged_databases(tmpdir):
+    path = str(tmpdir.join('db_diffs.sqlite'))
+    writer = SQLightWriter(path)
+    writer.write_stream('kept', diff_stream(1), 'reference')
+    writer.write_stream('rerun', diff_stream(3), 'reference')
+
+    partial_path = str(tmpdir.join('db_diffs.worker.sqlite'))
+    partial = SQLightWriter(partial_path)
+    partial.write_stream('rerun', diff_stream(2), 'reference')
+    partial.write_stream('new', diff_stream(1), 'reference')
+    partial.connection.close()
+
+    assert writer.merge(partial_path) == 2
+    assert [row['name'] for row in writer.connection.execute("SELECT name FROM database ORDER BY name")] == \
+        ['kept', 'new', 'rerun']
+    assert [row['path'] for row in differences(writer, 'rerun')] == ['users.c0.udt_name', 'users.c1.udt_name']
+    assert len(differences(writer, 'kept')) == 1
+    fingerprints = dict((row['name'], row['fingerprint'])
+                        for row in writer.connection.execute("SELECT name, fingerprint FROM database"))
+    assert fingerprints['kept'] == fingerprints['new']
+    assert fingerprints['rerun'] != fingerprints['kept']